@@ -0,0 +1,62 @@
+import argparse
+import os
+from datetime import datetime, time
+from dotenv import load_dotenv
+load_dotenv()  # storage مسیر دیتابیس را هنگام import از محیط می‌خواند
+import jdatetime
+import storage
+
+# ------------------ COLD DATA ARCHIVE ------------------
+# هزینه‌های سال‌های شمسی بسته‌شده از جدول اصلی به ARCHIVE_DIR/expenses_<سال>.db منتقل می‌شوند تا جدول و ایندکس
+# داغ فقط سال جاری را نگه دارند. جمع‌های ماهانه و روزانه دست نمی‌خورند (کل سابقه را پوشش می‌دهند)؛ خروجی از نمای
+# all_expenses و بازسازی جمع‌ها از all_expense_amounts می‌خوانند. اجرا با دستور ادمین /archive یا به صورت دوره‌ای:
+#   python archive.py [--vacuum]
+
+def year_range(j_year):
+    start = datetime.combine(jdatetime.date(j_year, 1, 1).togregorian(), time.min)
+    end = datetime.combine(jdatetime.date(j_year + 1, 1, 1).togregorian(), time.min)
+    return start, end
+
+def closed_years():
+    """سال‌های شمسی پیش از سال جاری که هنوز هزینه‌ای از آن‌ها در سابقه هست."""
+    current = jdatetime.date.today().year
+    return [row[0] for row in storage.fetchall("SELECT DISTINCT j_year FROM monthly_totals WHERE count > 0 AND j_year < ? ORDER BY j_year", (current,))]
+
+def archive_year(j_year):
+    """هزینه‌های سال شمسی j_year را به فایل آرشیو همان سال منتقل می‌کند و تعداد ردیف‌های منتقل‌شده را برمی‌گرداند."""
+    if j_year >= jdatetime.date.today().year:
+        raise ValueError(f'{j_year} is not a closed year')
+    start, end = year_range(j_year)
+    os.makedirs(storage.ARCHIVE_DIR, exist_ok=True)
+    conn = storage.get_conn()
+    schema = storage.attach_archive(conn, j_year)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {schema}.expenses (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL, category TEXT NOT NULL, note TEXT, timestamp DATETIME NOT NULL)')
+    storage.create_expense_index(conn, schema)
+    with storage.transaction() as cursor:
+        cursor.execute('BEGIN IMMEDIATE')
+        # با WAL، commit روی چند فایل فقط برای هر فایل جداگانه اتمیک است؛ اگر اجرای قبلی بعد از نوشتن آرشیو و
+        # پیش از حذف از جدول اصلی قطع شده باشد، نسخه‌ی تکراری در جدول اصلی اول پاک می‌شود
+        cursor.execute(f"DELETE FROM main.expenses WHERE timestamp >= ? AND timestamp < ? AND id IN (SELECT id FROM {schema}.expenses)", (start, end))
+        cursor.execute(f"INSERT INTO {schema}.expenses ({storage.EXPENSE_COLUMNS}) SELECT {storage.EXPENSE_COLUMNS} FROM main.expenses WHERE timestamp >= ? AND timestamp < ?", (start, end))
+        moved = cursor.execute("DELETE FROM main.expenses WHERE timestamp >= ? AND timestamp < ?", (start, end)).rowcount
+    storage.refresh_archives()
+    return moved
+
+def archive_closed_years():
+    """همه‌ی سال‌های بسته‌شده را بایگانی می‌کند و {سال: تعداد ردیف منتقل‌شده} را برمی‌گرداند."""
+    return {j_year: archive_year(j_year) for j_year in closed_years()}
+
+def vacuum():
+    """فضای آزادشده‌ی جدول اصلی را به سیستم‌عامل برمی‌گرداند؛ در این مدت نوشتن‌های دیگر منتظر می‌مانند."""
+    storage.get_conn().execute('VACUUM main')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move expenses of closed Shamsi years into per-year archive databases')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM the main database afterwards')
+    args = parser.parse_args()
+    storage.migrate()
+    for j_year, moved in archive_closed_years().items():
+        print(f"📦 {j_year}: {moved} rows -> {storage.archive_path(j_year)}")
+    if args.vacuum:
+        vacuum()
+    storage.close_all()
@@ -0,0 +1,348 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from expense_parser import extract_amount
+
+# ------------------ BENCHMARKS ------------------
+# بنچمارک‌های آفلاین ربات؛ هیچ درخواستی به تلگرام یا Gemini واقعی فرستاده نمی‌شود.
+#   python bench.py --output bench_results.json
+#   python bench.py --scenarios text,report --users 500 --expenses-per-user 1000 --gemini-latency-ms 800
+# سناریوهای بار هندلرهای واقعی main.py را روی یک دیتابیس مصنوعی (users × expenses-per-user) و از مسیر
+# UserOrderedExecutor اجرا می‌کنند؛ تلگرام با یک بات ضبط‌کننده و Gemini با یک سرور HTTP محلی با تأخیر قابل تنظیم
+# جایگزین می‌شود. هر سناریو در پروسه‌ی جدا اجرا می‌شود تا حافظه‌ی اوج (peak RSS) مخصوص همان سناریو باشد.
+# با --max-import-ms، --max-first-update-ms و --max-p99-ms می‌توان آن را در CI به عنوان تست رگرسیون اجرا کرد
+# (در صورت عبور از آستانه کد خروج ۱ است). سناریوی startup در tests/test_startup.py هم با بودجه‌ی ثابت اجرا می‌شود.
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# این کد در یک پروسه‌ی تازه اجرا می‌شود تا import‌ها واقعاً سرد باشند
+STARTUP_CHILD = r'''
+import json, resource, sys, threading, time
+t_start = time.perf_counter()
+import main
+t_imported = time.perf_counter()
+from telebot import types
+handled = threading.Event()
+def record(*args, **kwargs):
+    handled.set()
+for name in ('send_message', 'reply_to', 'send_chat_action'):
+    setattr(main.bot, name, record)
+main.init_db()
+t_ready = time.perf_counter()
+update = types.Update.de_json({'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': '/start',
+    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    'chat': {'id': 42, 'type': 'private'}, 'from': {'id': 42, 'is_bot': False, 'first_name': 'bench'}}})
+main.bot.process_new_updates([update])
+handled.wait(30)
+t_handled = time.perf_counter()
+main.bot.executor.shutdown()
+print(json.dumps({
+    'import_ms': (t_imported - t_start) * 1000,
+    'init_db_ms': (t_ready - t_imported) * 1000,
+    'first_update_ms': (t_handled - t_start) * 1000,
+    'heavy_modules_loaded': sorted(m for m in ('pandas', 'matplotlib', 'openpyxl', 'pyarrow', 'aiohttp') if m in sys.modules),
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+'''
+
+def bench_env(db_path):
+    env = dict(os.environ)
+    env.update({
+        'DB_PATH': db_path,
+        'BOT_TOKEN': env.get('BENCH_BOT_TOKEN', '123456:bench'),
+        'ADMIN_USER_ID': '1',
+        'GEMINI_URL': env.get('BENCH_GEMINI_URL', 'http://127.0.0.1:9/unreachable'),
+    })
+    return env
+
+def bench_startup(args):
+    """زمان import، زمان تا اولین آپدیت پردازش‌شده و حافظه‌ی پروسه در شروع سرد (میانه‌ی چند اجرا)."""
+    runs = []
+    for _ in range(args.startup_runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = subprocess.run([sys.executable, '-c', STARTUP_CHILD], cwd=REPO_DIR, env=bench_env(os.path.join(tmp, 'bench.db')),
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+    runs.sort(key=lambda run: run['first_update_ms'])
+    result = dict(runs[len(runs) // 2])
+    result['runs'] = len(runs)
+    return result
+
+# ------------------ SYNTHETIC DATABASE ------------------
+SEED_CHILD = r'''
+import json, random, sys
+from datetime import datetime, timedelta
+import jdatetime
+import storage
+from expense_parser import CATEGORIES
+users, per_user, seed = json.loads(sys.argv[1])
+random.seed(seed)
+storage.migrate()
+now = datetime.now()
+j_now = jdatetime.date.today()
+with storage.transaction() as cursor:
+    cursor.executemany("INSERT INTO users (user_id, first_name, username, join_date, last_seen_shamsi_month) VALUES (?, ?, ?, ?, ?)",
+                       [(1000 + u, f'user{u}', None, now - timedelta(days=400), j_now.month) for u in range(users)])
+    cursor.executemany("INSERT INTO budgets (user_id, year, month, amount) VALUES (?, ?, ?, ?)",
+                       [(1000 + u, j_now.year, j_now.month, 50_000_000) for u in range(users)])
+    for u in range(users):
+        cursor.executemany("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)",
+                           [(1000 + u, random.randrange(10, 2000) * 1000, random.choice(CATEGORIES), f'note {i}',
+                             now - timedelta(seconds=random.randrange(365 * 86400))) for i in range(per_user)])
+    storage.rebuild_monthly_totals(cursor)
+    storage.rebuild_daily_totals(cursor)
+storage.close_all()
+'''
+
+def seed_database(path, args):
+    subprocess.run([sys.executable, '-c', SEED_CHILD, json.dumps([args.users, args.expenses_per_user, args.seed])],
+                   cwd=REPO_DIR, env=bench_env(path), check=True)
+
+# ------------------ STUB GEMINI SERVER ------------------
+SINGLE_PROMPT = re.compile(r'Extract from "(.*?)" into JSON')
+
+def _fake_extraction(text):
+    amount, _ = extract_amount(text)
+    if amount is None:
+        # بدون مبلغ یکتا، عدد اول به هزار تومان
+        number = re.search(r'\d+', text)
+        amount = int(number.group()) * 1000 if number else 1000
+    return {'amount': amount, 'category': 'سایر', 'note': text}
+
+class StubGeminiServer(ThreadingHTTPServer):
+    """پاسخ‌هایی هم‌شکل با generateContent (تکی یا آرایه‌ای برای prompt دسته‌ای) بعد از latency ثانیه تأخیر."""
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), _StubGeminiHandler)
+        self.latency = latency
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/generate'
+
+class _StubGeminiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        prompt = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['contents'][0]['parts'][0]['text']
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        single = SINGLE_PROMPT.search(prompt)
+        # prompt دسته‌ای: آرایه‌ی JSON پیام‌ها در خط آخر
+        result = _fake_extraction(single.group(1)) if single else [{'i': message['i'], **_fake_extraction(message['text'])} for message in json.loads(prompt.rsplit('\n', 1)[1])]
+        body = json.dumps({'candidates': [{'content': {'parts': [{'text': json.dumps(result, ensure_ascii=False)}]}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# ------------------ HANDLER LOAD SCENARIOS ------------------
+# کد پروسه‌ی فرزند: بات ضبط‌کننده، ساخت آپدیت‌ها و اجرای هندلر از مسیر executor با زمان‌سنجی هر عملیات.
+# تأخیر هر عملیات از لحظه‌ی submit تا پایان هندلر است، پس زمان انتظار در صف کاربر هم در آن حساب می‌شود.
+LOAD_CHILD = r'''
+import json, random, resource, sys, threading, time
+from collections import Counter
+from types import SimpleNamespace
+import main, charts, storage
+from telebot import types
+config = json.loads(sys.argv[1])
+random.seed(config['seed'])
+main.init_db()
+charts.start()
+
+class RecordingBot:
+    """متدهای شبکه‌ای main.bot را با نسخه‌ای جایگزین می‌کند که فقط فراخوانی‌ها را می‌شمارد."""
+    METHODS = ('send_message', 'reply_to', 'send_document', 'send_photo', 'edit_message_text',
+               'send_chat_action', 'answer_callback_query', 'register_next_step_handler')
+
+    def __init__(self, bot):
+        self.calls = Counter()
+        for name in self.METHODS:
+            setattr(bot, name, self._recorder(name))
+
+    def _recorder(self, name):
+        def method(*args, **kwargs):
+            self.calls[name] += 1
+            for value in (*args, *kwargs.values()):
+                # فایل‌ها مثل آپلود واقعی تا آخر خوانده می‌شوند
+                if isinstance(value, tuple) and len(value) == 2 and hasattr(value[1], 'read'):
+                    value[1].read()
+            chat_id = args[0] if args and isinstance(args[0], int) else 0
+            return SimpleNamespace(message_id=1, chat=SimpleNamespace(id=chat_id))
+        return method
+
+recorder = RecordingBot(main.bot)
+user_ids = [1000 + u for u in range(config['users'])]
+
+def message(user_id, text, message_id):
+    data = {'message_id': message_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'}, 'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'}}
+    if text.startswith('/'):
+        data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return types.Message.de_json(data)
+
+def text_op(i):
+    user_id = random.choice(user_ids)
+    if random.random() < config['llm_ratio']:
+        # متن منحصربه‌فرد تا کش پاسخ هوش مصنوعی دور زده شود
+        return user_id, main.handle_text_message, message(user_id, f'{random.randrange(1, 900)} تومن بابت سفارش شماره {i} از فروشگاه', i)
+    return user_id, main.handle_text_message, message(user_id, f'{random.randrange(1, 900)} هزار {random.choice(["ناهار", "تاکسی", "قبض برق", "سینما", "دارو"])}', i)
+
+def command_op(handler, texts):
+    def op(i):
+        user_id = random.choice(user_ids)
+        return user_id, handler, message(user_id, random.choice(texts), i)
+    return op
+
+expense_rows = storage.fetchall("SELECT user_id, id FROM expenses ORDER BY id DESC LIMIT ?", (config['ops'] + config['warmup'],))
+def callback_op(i):
+    user_id, expense_id = expense_rows[i % len(expense_rows)]
+    call = types.CallbackQuery.de_json({'id': str(i), 'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+                                        'chat_instance': 'bench', 'data': f'delete|{expense_id}',
+                                        'message': {'message_id': i, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'x'}})
+    return user_id, main.handle_callback_query, call
+
+OPS = {
+    'text': text_op,
+    'report': command_op(main.handle_report, ['/reportdaily', '/reportweekly']),
+    'budget': command_op(main.handle_budget_status, ['/budget']),
+    'export': command_op(main.handle_export, ['/export']),
+    'callback': callback_op,
+}
+
+def run(count, offset):
+    make = OPS[config['scenario']]
+    # مثل DispatchingTeleBot: دستورهای سبک و دکمه‌ها در مسیر دستورها
+    command = config['scenario'] in ('report', 'budget', 'callback')
+    latencies, done = [], threading.Semaphore(0)
+    def timed(handler, update, submitted):
+        try:
+            handler(update)
+        except Exception as e:
+            print(f"❌ Bench handler Error: {e!r}", file=sys.stderr)
+        finally:
+            latencies.append(time.perf_counter() - submitted)
+            done.release()
+    started = time.perf_counter()
+    for i in range(offset, offset + count):
+        user_id, handler, update = make(i)
+        main.bot.executor.submit(user_id, timed, handler, update, time.perf_counter(), command=command)
+    for _ in range(count):
+        done.acquire()
+    return latencies, time.perf_counter() - started
+
+run(config['warmup'], 0)
+latencies, elapsed = run(config['ops'], config['warmup'])
+main.bot.executor.shutdown()
+charts.shutdown()
+latencies.sort()
+percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+print(json.dumps({
+    'ops': len(latencies),
+    'seconds': elapsed,
+    'throughput_ops_s': len(latencies) / elapsed,
+    'p50_ms': percentile(0.50),
+    'p99_ms': percentile(0.99),
+    'max_ms': latencies[-1] * 1000,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'telegram_calls': dict(recorder.calls),
+}))
+'''
+
+LOAD_SCENARIOS = ('text', 'report', 'budget', 'export', 'callback')
+_fixture = {}
+
+def _load_fixture(args):
+    """دیتابیس مصنوعی و سرور Gemini ساختگی یک بار برای همه‌ی سناریوهای بار ساخته می‌شوند."""
+    if not _fixture:
+        _fixture['dir'] = tempfile.TemporaryDirectory()
+        _fixture['db'] = os.path.join(_fixture['dir'].name, 'seed.db')
+        seed_database(_fixture['db'], args)
+        server = StubGeminiServer(args.gemini_latency_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _fixture['gemini'] = server
+    return _fixture
+
+def bench_load(scenario, args):
+    """گذردهی، تأخیر p50/p99 و حافظه‌ی اوج یک سناریوی هندلر روی دیتابیس مصنوعی."""
+    fixture = _load_fixture(args)
+    # هر سناریو روی کپی تازه‌ی دیتابیس اجرا می‌شود چون بعضی سناریوها داده را تغییر می‌دهند
+    db_path = os.path.join(fixture['dir'].name, f'{scenario}.db')
+    shutil.copyfile(fixture['db'], db_path)
+    ops = max(1, args.ops // 10) if scenario == 'export' else args.ops
+    config = {'scenario': scenario, 'users': args.users, 'ops': ops, 'warmup': min(20, ops), 'seed': args.seed, 'llm_ratio': args.llm_ratio}
+    env = bench_env(db_path)
+    env['GEMINI_URL'] = fixture['gemini'].url
+    if args.workers:
+        env['WORKER_THREADS'] = str(args.workers)
+    gemini_before = fixture['gemini'].requests
+    output = subprocess.run([sys.executable, '-c', LOAD_CHILD, json.dumps(config)], cwd=REPO_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['gemini_requests'] = fixture['gemini'].requests - gemini_before
+    return result
+
+def _load_scenario(name):
+    return lambda args: bench_load(name, args)
+
+SCENARIOS = {'startup': bench_startup, **{name: _load_scenario(name) for name in LOAD_SCENARIOS}}
+
+def check_thresholds(results, args):
+    failures = []
+    startup = results.get('startup')
+    if startup:
+        if args.max_import_ms is not None and startup['import_ms'] > args.max_import_ms:
+            failures.append(f"startup import {startup['import_ms']:.0f}ms > {args.max_import_ms}ms")
+        if args.max_first_update_ms is not None and startup['first_update_ms'] > args.max_first_update_ms:
+            failures.append(f"startup first update {startup['first_update_ms']:.0f}ms > {args.max_first_update_ms}ms")
+        if startup['heavy_modules_loaded']:
+            failures.append(f"heavy modules imported at startup: {', '.join(startup['heavy_modules_loaded'])}")
+    for name in LOAD_SCENARIOS:
+        result = results.get(name)
+        if result and args.max_p99_ms is not None and result['p99_ms'] > args.max_p99_ms:
+            failures.append(f"{name} p99 {result['p99_ms']:.0f}ms > {args.max_p99_ms}ms")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the bot')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--startup-runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-first-update-ms', type=float)
+    parser.add_argument('--users', type=int, default=200, help='synthetic users in the seeded database')
+    parser.add_argument('--expenses-per-user', type=int, default=300)
+    parser.add_argument('--ops', type=int, default=500, help='operations per load scenario (export runs a tenth of this)')
+    parser.add_argument('--gemini-latency-ms', type=float, default=300, help='latency of the stub Gemini server')
+    parser.add_argument('--llm-ratio', type=float, default=0.3, help='share of text messages the local parser cannot handle')
+    parser.add_argument('--workers', type=int, help='WORKER_THREADS for the bot process')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-p99-ms', type=float, help='fail if any load scenario p99 exceeds this')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenarios.split(','):
+        print(f"⏱️ {name}...")
+        results[name] = SCENARIOS[name](args)
+        print(json.dumps(results[name], ensure_ascii=False, indent=2))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failures = check_thresholds(results, args)
+    for failure in failures:
+        print(f"❌ {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
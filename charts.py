@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import jdatetime
+import metrics
+import storage
+from export import category_totals
+
+# ------------------ CHART SERVICE ------------------
+# نمودارها در یک استخر پروسه‌ی گرم و با API شیءگرای Figure رسم می‌شوند (نه state سراسری pyplot)،
+# پس CPU رسم نمودار نه GIL تردهای ربات را می‌گیرد و نه بین تردها تداخل دارد.
+# خروجی PNG با کلید (کاربر، نوع نمودار، بازه، روز) کش می‌شود و هر تغییر در هزینه‌های کاربر نمودارهای کش‌شده‌ی او را حذف می‌کند.
+CHART_WORKERS = int(os.environ.get('CHART_WORKERS', '2'))
+CHART_CACHE_SIZE = int(os.environ.get('CHART_CACHE_SIZE', '256'))
+CHART_TIMEOUT = float(os.environ.get('CHART_TIMEOUT', '30'))
+CHART_TYPES = ('pie', 'monthly', 'daily')
+CHART_STYLE = 'seaborn-v0_8-pastel'
+
+# ------------------ RENDERING (worker process) ------------------
+def _warm_up():
+    import matplotlib
+    matplotlib.use('Agg')
+    # ماژول‌هایی که _render لازم دارد پیش از اولین نمودار بارگذاری می‌شوند
+    import matplotlib.figure
+    import matplotlib.style
+
+def _render(chart_type, labels, values, title):
+    from io import BytesIO
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    with matplotlib.style.context(CHART_STYLE):
+        fig = Figure(figsize=(10, 8))
+        ax = fig.subplots()
+        if chart_type == 'pie':
+            ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=90); ax.axis('equal')
+        elif chart_type == 'monthly':
+            ax.plot(labels, values, marker='o')
+            ax.tick_params(axis='x', rotation=45)
+        else:
+            ax.bar(labels, values)
+        ax.set_title(title)
+        buffer = BytesIO()
+        fig.savefig(buffer, format='PNG', bbox_inches='tight')
+    return buffer.getvalue()
+
+# ------------------ DATA (bot threads) ------------------
+def _pie_data(user_id, start, end):
+    rows = category_totals(user_id, start, end)
+    return [row[0] for row in rows], [row[1] for row in rows], 'توزیع هزینه‌ها'
+
+def _monthly_data(user_id, start, end):
+    rows = storage.fetchall("SELECT j_year, j_month, total FROM monthly_totals WHERE user_id = ? AND count > 0 ORDER BY j_year DESC, j_month DESC LIMIT 12", (user_id,))
+    rows.reverse()
+    return [f"{y}/{m:02d}" for y, m, _ in rows], [row[2] for row in rows], 'روند ماهانه هزینه‌ها'
+
+def _daily_data(user_id, start, end):
+    if start is None or end is None:
+        j_today = jdatetime.date.today()
+        start = datetime.combine(jdatetime.date(j_today.year, j_today.month, 1).togregorian(), datetime.min.time())
+        end = datetime.combine(j_today.togregorian(), datetime.min.time()) + timedelta(days=1)
+    rows = storage.fetchall("SELECT day, SUM(total) FROM daily_category_totals WHERE user_id = ? AND day >= ? AND day < ? GROUP BY day HAVING SUM(count) > 0 ORDER BY day", (user_id, start.date().isoformat(), end.date().isoformat()))
+    labels = [jdatetime.date.fromgregorian(date=datetime.strptime(day, '%Y-%m-%d').date()).strftime('%m/%d') for day, _ in rows]
+    return labels, [row[1] for row in rows], 'هزینه‌های روزانه'
+
+DATA_SOURCES = {'pie': _pie_data, 'monthly': _monthly_data, 'daily': _daily_data}
+
+# ------------------ POOL & CACHE ------------------
+_lock = threading.Lock()
+_pool = None
+_cache = OrderedDict()
+# رسم‌های در حال انجام هر کاربر به شکل [تعداد، نسخه]. invalidate نمودارهای کش‌شده را حذف می‌کند و فقط نسخه‌ی رسم‌های
+# در حال انجام را بالا می‌برد تا نتیجه‌ی رسمی که پیش از تغییر داده شروع شده کش نشود؛ پس این دیکشنری هیچ‌وقت از
+# تعداد رسم‌های هم‌زمان بزرگ‌تر نمی‌شود.
+_rendering = {}
+# کارگرها از یک پروسه‌ی forkserver تک‌ترد (یا با spawn) ساخته می‌شوند، نه با fork از پروسه‌ی ربات که تردهای کارگر،
+# flusherها و سرور متریک دارد؛ پس ساختن دوباره‌ی استخر بعد از BrokenProcessPool در هر زمانی بی‌خطر است
+# (در این حالت ماژول اجراشده دوباره import می‌شود، پس نقطه‌های ورود باید شرط __name__ == '__main__' را داشته باشند)
+_MP_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+def _noop():
+    return None
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=_MP_CONTEXT, initializer=_warm_up)
+        return _pool
+
+def start():
+    """
+    استخر پروسه را از پیش گرم می‌کند تا اولین نمودار منتظر ساخته شدن کارگرها و import شدن matplotlib نماند.
+    منتظر نتیجه‌ی همین submit نمی‌مانیم تا شروع ربات کند نشود.
+    """
+    _get_pool().submit(_noop)
+
+def _reset_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def invalidate(user_id):
+    """بعد از هر تغییر در هزینه‌های کاربر صدا زده می‌شود تا نمودارهای کش‌شده‌ی او دیگر استفاده نشوند."""
+    with _lock:
+        state = _rendering.get(user_id)
+        if state is not None:
+            state[1] += 1
+        for key in [key for key in _cache if key[0] == user_id]:
+            del _cache[key]
+
+def _draw(user_id, chart_type, start, end):
+    labels, values, title = DATA_SOURCES[chart_type](user_id, start, end)
+    if not values:
+        return None
+    try:
+        with metrics.timer(metrics.CHART_SECONDS, type=chart_type):
+            return _get_pool().submit(_render, chart_type, labels, values, title).result(timeout=CHART_TIMEOUT)
+    except BrokenProcessPool:
+        _reset_pool()
+        raise
+
+def render_chart(user_id, chart_type='pie', start=None, end=None):
+    """PNG نمودار را (از کش یا با رسم در استخر پروسه) برمی‌گرداند؛ اگر داده‌ای نباشد None."""
+    with _lock:
+        # تاریخ روز هم جزو کلید است چون نمودار روزانه‌ی بدون بازه به «امروز» وابسته است
+        key = (user_id, chart_type, start, end, datetime.now().date())
+        png = _cache.get(key)
+        if png is not None:
+            _cache.move_to_end(key)
+            metrics.CHART_CACHE.inc(result='hit')
+            return png
+        state = _rendering.setdefault(user_id, [0, 0])
+        state[0] += 1
+        version = state[1]
+    metrics.CHART_CACHE.inc(result='miss')
+    png = None
+    try:
+        png = _draw(user_id, chart_type, start, end)
+    finally:
+        with _lock:
+            state[0] -= 1
+            if not state[0]:
+                del _rendering[user_id]
+            # اگر در حین رسم داده‌ی کاربر تغییر کرده باشد، این نتیجه کهنه است و کش نمی‌شود
+            if png is not None and state[1] == version:
+                _cache[key] = png
+                while len(_cache) > CHART_CACHE_SIZE:
+                    _cache.popitem(last=False)
+    return png
+
+def shutdown():
+    _reset_pool()
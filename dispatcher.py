@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import telebot
+import stats
+
+# ------------------ USER-ORDERED DISPATCHER ------------------
+# آپدیت‌ها روی یک استخر ترد محدود پخش می‌شوند، ولی آپدیت‌های یک کاربر همیشه به ترتیب رسیدن
+# و پشت سر هم اجرا می‌شوند تا register_next_step_handler و user_state با هم تداخل نکنند.
+# دستورهای سبک و دکمه‌ها در مسیر جدای COMMAND_WORKER_THREADS اجرا می‌شوند تا وقتی همه‌ی کارگرهای عادی منتظر
+# Gemini هستند، /budget و /undo بقیه‌ی کاربران پشت آن‌ها صف نکشند. ترتیب آپدیت‌های هر کاربر بین دو مسیر هم حفظ می‌شود.
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', '8'))
+COMMAND_WORKER_THREADS = int(os.environ.get('COMMAND_WORKER_THREADS', '2'))
+MAX_PENDING_UPDATES = int(os.environ.get('MAX_PENDING_UPDATES', '256'))
+# بعد از این تعداد آپدیت پشت سر هم از یک کاربر، ترد به بقیه‌ی کاربران هم نوبت می‌دهد
+FAIRNESS_BATCH = 8
+
+class UserOrderedExecutor:
+    def __init__(self, max_workers=WORKER_THREADS, max_pending=MAX_PENDING_UPDATES, command_workers=COMMAND_WORKER_THREADS):
+        # اندیس 0 مسیر عادی و اندیس 1 مسیر دستورها
+        self._pools = (ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jibjib-worker'),
+                       ThreadPoolExecutor(max_workers=command_workers, thread_name_prefix='jibjib-command'))
+        self._slots = threading.Semaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._pending = 0
+
+    def submit(self, key, fn, *args, timeout=None, command=False):
+        """
+        کار را در صف کاربر key قرار می‌دهد (با command=True روی مسیر دستورها). اگر صف کلی پر باشد تا timeout
+        ثانیه منتظر می‌ماند (فشار برگشتی روی polling) و در صورت تمام شدن زمان False برمی‌گرداند.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            return False
+        lane = int(command)
+        with self._lock:
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((lane, fn, args))
+                return True
+            self._queues[key] = deque([(lane, fn, args)])
+        self._pools[lane].submit(self._drain, key, lane)
+        return True
+
+    def _schedule(self, key, lane):
+        try:
+            self._pools[lane].submit(self._drain, key, lane)
+        except RuntimeError:
+            # استخر آن مسیر در حال خاموش شدن است؛ باقی صف کاربر همین‌جا اجرا می‌شود
+            self._drain(key, lane)
+
+    def _drain(self, key, lane):
+        for _ in range(FAIRNESS_BATCH):
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                if queue[0][0] != lane:
+                    # کار بعدی کاربر مال مسیر دیگر است؛ تا این کار تمام نشده برداشته نشده بود، پس ترتیب حفظ می‌شود
+                    break
+                _, fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"❌ Worker Error (user {key}): {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                self._slots.release()
+        # صف این کاربر هنوز خالی نشده؛ به انتهای صف استخر مسیر کار بعدی برمی‌گردد
+        with self._lock:
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return
+            lane = queue[0][0]
+        self._schedule(key, lane)
+
+    def queue_depth(self):
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        for pool in self._pools:
+            pool.shutdown(wait=wait)
+
+def update_user_id(update):
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result', 'pre_checkout_query', 'shipping_query'):
+        event = getattr(update, field, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return f'update-{update.update_id}'
+
+def is_command_update(update, slow_commands=()):
+    """دکمه‌ها و دستورهای متنی به جز slow_commands (که فایل یا نمودار می‌سازند) در مسیر دستورها اجرا می‌شوند."""
+    if update.callback_query is not None:
+        return True
+    text = update.message.text if update.message is not None else None
+    if not text or not text.startswith('/'):
+        return False
+    command = text.split()[0][1:].split('@')[0].lower()
+    return command not in slow_commands
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot که هر آپدیت را به جای اجرای درجا، در صف کاربر مربوطه روی UserOrderedExecutor می‌گذارد."""
+    def __init__(self, token, executor=None, slow_commands=(), **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.executor = executor or UserOrderedExecutor()
+        self.slow_commands = frozenset(slow_commands)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # offset باید همین‌جا جلو برود، وگرنه polling بعدی همین آپدیت‌ها را دوباره می‌گیرد
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            if update.message is not None:
+                stats.record_message(update_user_id(update))
+            self.executor.submit(update_user_id(update), super().process_new_updates, [update],
+                                 command=is_command_update(update, self.slow_commands))
+
+    def process_updates_inline(self, updates):
+        """آپدیت‌ها را همین‌جا و در همین ترد با هندلرهای همگام اجرا می‌کند (برای حالت webhook که صف کاربر را خودش نگه می‌دارد)."""
+        super().process_new_updates(updates)
+
+    def has_next_step_handler(self, chat_id):
+        return bool(self.next_step_backend.handlers.get(chat_id))
+
+    def stop_bot(self):
+        super().stop_bot()
+        self.executor.shutdown()
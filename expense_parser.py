@@ -0,0 +1,134 @@
+import re
+import threading
+
+# ------------------ CATEGORIES ------------------
+CATEGORIES = ['غذا', 'حمل و نقل', 'خرید', 'تفریح', 'قبوض', 'سلامتی', 'آموزش', 'هدیه', 'اجاره', 'سایر']
+DEFAULT_CATEGORY = 'سایر'
+
+CATEGORY_KEYWORDS = {
+    'غذا': ['غذا', 'ناهار', 'نهار', 'شام', 'صبحانه', 'قهوه', 'کافه', 'کافی شاپ', 'رستوران', 'فست فود', 'پیتزا', 'ساندویچ',
+            'همبرگر', 'کباب', 'جوجه', 'چای', 'کیک', 'شیرینی', 'بستنی', 'نان', 'نون', 'میوه', 'تنقلات', 'اسنک', 'لبنیات',
+            'شیر', 'ماست', 'پنیر', 'گوشت', 'مرغ', 'برنج', 'نانوایی', 'آب معدنی', 'نوشابه'],
+    'حمل و نقل': ['حمل و نقل', 'تاکسی', 'اسنپ', 'تپسی', 'مترو', 'اتوبوس', 'بنزین', 'سوخت', 'کرایه', 'پارکینگ', 'عوارض',
+                  'قطار', 'هواپیما', 'پرواز', 'بلیط قطار', 'بلیط هواپیما', 'بلیط اتوبوس', 'کارواش', 'تعمیر ماشین'],
+    'خرید': ['خرید', 'لباس', 'کفش', 'کیف', 'گوشی', 'موبایل', 'لپ تاپ', 'لپتاپ', 'هدفون', 'لوازم', 'دیجی کالا', 'دیجیکالا',
+             'سوپرمارکت', 'سوپر مارکت', 'هایپر', 'فروشگاه', 'مانتو', 'شلوار', 'پیراهن'],
+    'تفریح': ['تفریح', 'سینما', 'بلیط سینما', 'فیلم', 'کنسرت', 'تئاتر', 'بازی', 'سفر', 'هتل', 'پارک', 'استخر', 'نتفلیکس',
+              'فیلیمو', 'نماوا', 'گیم'],
+    'قبوض': ['قبض', 'قبوض', 'برق', 'گاز', 'قبض آب', 'آب بها', 'اینترنت', 'شارژ', 'شارژ ساختمان', 'تلفن', 'قبض تلفن', 'بسته اینترنت'],
+    'سلامتی': ['سلامتی', 'دارو', 'داروخانه', 'دکتر', 'پزشک', 'دندانپزشک', 'دندان پزشک', 'بیمارستان', 'آزمایش', 'ویزیت',
+               'عینک', 'بیمه', 'باشگاه', 'ورزش'],
+    'آموزش': ['آموزش', 'کتاب', 'کلاس', 'دوره', 'شهریه', 'دانشگاه', 'مدرسه', 'لوازم التحریر', 'دفتر', 'خودکار'],
+    'هدیه': ['هدیه', 'کادو', 'عیدی', 'تولد', 'گل'],
+    'اجاره': ['اجاره', 'اجاره خانه', 'اجاره خونه', 'کرایه خانه', 'کرایه خونه', 'رهن', 'ودیعه'],
+}
+
+# ------------------ AMOUNT ------------------
+CURRENCY_WORDS = ('تومان', 'تومن', 'ریال')
+
+def normalize_amount(text_amount):
+    if not text_amount: return None
+    persian_to_latin = str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')
+    text = text_amount.translate(persian_to_latin).replace('تومان', '').replace('تومن', '').replace('ریال', '').replace(',', '').strip()
+    multiplier = 1
+    if 'میلیون' in text:
+        multiplier = 1_000_000
+        text = text.replace('میلیون', '').strip()
+    elif 'هزار' in text:
+        multiplier = 1_000
+        text = text.replace('هزار', '').strip()
+    try:
+        return float(text) * multiplier
+    except ValueError:
+        return None
+
+# یک عدد (فارسی یا لاتین) به همراه «هزار/میلیون» و واحد پول اختیاری
+AMOUNT_PATTERN = re.compile(r'[0-9۰-۹][0-9۰-۹,]*(?:\.[0-9۰-۹]+)?(?:\s*(?:هزار|میلیون))?(?:\s*(?:تومان|تومن|ریال))?')
+
+def extract_amount(text):
+    """اگر متن دقیقاً یک مبلغ معتبر داشته باشد (مبلغ، match) و در غیر این صورت (None, None) برمی‌گرداند."""
+    amounts = list(AMOUNT_PATTERN.finditer(text))
+    if len(amounts) != 1:
+        return None, None
+    amount = normalize_amount(amounts[0].group())
+    if not amount or amount <= 0:
+        return None, None
+    return amount, amounts[0]
+
+# ------------------ KEYWORD TRIE ------------------
+# کلیدواژه‌ها به صورت دنباله‌ای از کلمه‌ها در یک trie نگه داشته می‌شوند تا عبارت‌های چندکلمه‌ای
+# مثل «قبض آب» یا «کرایه خانه» بر تک‌کلمه‌ها (آب، کرایه) اولویت داشته باشند.
+_END = object()
+
+def normalize_text(text):
+    text = text.replace('ي', 'ی').replace('ك', 'ک').replace('‌', ' ')
+    return re.sub(r'[^\w\s]', ' ', text)
+
+def _tokenize(text):
+    return normalize_text(text).split()
+
+def _build_trie(keywords_by_category):
+    root = {}
+    for category, keywords in keywords_by_category.items():
+        for keyword in keywords:
+            node = root
+            for word in _tokenize(keyword):
+                node = node.setdefault(word, {})
+            node[_END] = category
+    return root
+
+_KEYWORD_TRIE = _build_trie(CATEGORY_KEYWORDS)
+
+def classify_note(note):
+    """
+    دسته‌بندی توضیحات هزینه را با طولانی‌ترین کلیدواژه‌های پیدا شده تعیین می‌کند.
+    خروجی (دسته، مطمئن؟) است؛ اگر کلیدواژه‌ای پیدا نشود یا دسته‌های متفاوتی پیدا شوند مطمئن نیست.
+    """
+    tokens = _tokenize(note)
+    matched = set()
+    i = 0
+    while i < len(tokens):
+        node, match, match_len = _KEYWORD_TRIE, None, 0
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None: break
+            if _END in node:
+                match, match_len = node[_END], j - i + 1
+        if match:
+            matched.add(match)
+            i += match_len
+        else:
+            i += 1
+    if len(matched) == 1:
+        return matched.pop(), True
+    return DEFAULT_CATEGORY, False
+
+# ------------------ PARSER ------------------
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+def _record(hit):
+    with _stats_lock:
+        _stats['hits' if hit else 'misses'] += 1
+
+def parser_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def parse_expense(text):
+    """
+    پیام‌های ساده مثل «۳۲۰۰۰ قهوه» یا «50 هزار تاکسی» را بدون هوش مصنوعی تحلیل می‌کند.
+    خروجی دیکشنری {'amount', 'category', 'note', 'confident'} است یا None اگر مبلغی پیدا نشود.
+    فقط وقتی confident برابر True است که دقیقاً یک مبلغ و یک دسته‌ی مشخص پیدا شده باشد.
+    """
+    amount, match = extract_amount(text)
+    if not amount:
+        _record(False)
+        return None
+    note = (text[:match.start()] + ' ' + text[match.end():])
+    for word in CURRENCY_WORDS:
+        note = note.replace(word, ' ')
+    note = ' '.join(note.split())
+    category, confident = classify_note(note)
+    _record(confident)
+    return {'amount': amount, 'category': category, 'note': note, 'confident': confident}
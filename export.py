@@ -0,0 +1,104 @@
+import csv
+import io
+import os
+import tempfile
+import metrics
+import storage
+
+# ------------------ STREAMING EXPORT ------------------
+# ردیف‌ها صفحه‌به‌صفحه از کرسر خوانده و مستقیماً در فایل خروجی نوشته می‌شوند، پس حافظه‌ی مصرفی
+# به طول سابقه‌ی کاربر بستگی ندارد. فایل خروجی تا EXPORT_SPOOL_BYTES در حافظه و بعد از آن روی دیسک نگه داشته می‌شود.
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', '2000'))
+EXPORT_SPOOL_BYTES = int(os.environ.get('EXPORT_SPOOL_BYTES', str(4 * 1024 * 1024)))
+COLUMNS = ['timestamp', 'amount', 'category', 'note']
+FORMATS = ('xlsx', 'csv', 'parquet')
+
+class ExportFormatUnavailable(Exception):
+    pass
+
+def _range_filter(start, end):
+    sql, params = "", []
+    if start is not None:
+        sql += " AND timestamp >= ?"; params.append(start)
+    if end is not None:
+        sql += " AND timestamp < ?"; params.append(end)
+    return sql, params
+
+def iter_expense_pages(user_id, start=None, end=None, page_size=EXPORT_PAGE_SIZE):
+    range_sql, range_params = _range_filter(start, end)
+    cursor = storage.get_conn().cursor()
+    try:
+        # all_expenses شامل آرشیو سال‌های بسته‌شده هم هست
+        cursor.execute(f"SELECT timestamp, amount, category, note FROM {storage.ALL_EXPENSES} WHERE user_id = ?{range_sql} ORDER BY timestamp", (user_id, *range_params))
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows: break
+            yield rows
+    finally:
+        cursor.close()
+
+def category_totals(user_id, start=None, end=None):
+    range_sql, range_params = _range_filter(start, end)
+    return storage.fetchall(f"SELECT category, SUM(amount) FROM {storage.ALL_EXPENSE_AMOUNTS} WHERE user_id = ?{range_sql} GROUP BY category ORDER BY SUM(amount) DESC", (user_id, *range_params))
+
+def _write_xlsx(pages, out):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Expenses')
+    sheet.append(COLUMNS)
+    count = 0
+    for rows in pages:
+        for row in rows:
+            sheet.append(row)
+        count += len(rows)
+    workbook.save(out)
+    return count
+
+def _write_csv(pages, out):
+    # utf-8-sig تا اکسل متن فارسی را درست نشان دهد
+    text = io.TextIOWrapper(out, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(COLUMNS)
+    count = 0
+    for rows in pages:
+        writer.writerows(rows)
+        count += len(rows)
+    text.flush()
+    text.detach()
+    return count
+
+def _write_parquet(pages, out):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportFormatUnavailable('parquet')
+    schema = pa.schema([('timestamp', pa.string()), ('amount', pa.float64()), ('category', pa.string()), ('note', pa.string())])
+    count = 0
+    with pq.ParquetWriter(out, schema) as writer:
+        for rows in pages:
+            # هر صفحه یک row group جدا است
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            count += len(rows)
+    return count
+
+WRITERS = {'xlsx': _write_xlsx, 'csv': _write_csv, 'parquet': _write_parquet}
+
+def export_expenses(user_id, fmt='xlsx', start=None, end=None):
+    """
+    هزینه‌های کاربر را در قالب fmt در یک فایل موقت می‌نویسد و (فایل، تعداد ردیف) را برمی‌گرداند.
+    اگر ردیفی نباشد فایل None است. فایل باید بعد از ارسال بسته شود.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        with metrics.timer(metrics.EXPORT_SECONDS, format=fmt):
+            count = WRITERS[fmt](iter_expense_pages(user_id, start, end), out)
+    except BaseException:
+        out.close()
+        raise
+    if count == 0:
+        out.close()
+        return None, 0
+    out.seek(0)
+    return out, count
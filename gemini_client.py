@@ -0,0 +1,206 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+import rate_limit
+import stats
+
+# ------------------ GEMINI CLIENT ------------------
+# همه‌ی درخواست‌ها به Gemini از یک اتصال ماندگار (keep-alive) عبور می‌کنند تا هر پیام هزینه‌ی TLS handshake جدید نپردازد.
+# در حالت polling از requests.Session و در حالت webhook از aiohttp روی event loop سرور استفاده می‌شود.
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+GEMINI_URL = os.environ.get('GEMINI_URL', "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent")
+HEADERS = {'Content-Type': 'application/json'}
+# سرور ساختگی محلی کلید لازم ندارد؛ aiohttp هدر با مقدار None را نمی‌پذیرد
+if GEMINI_API_KEY:
+    HEADERS['x-goog-api-key'] = GEMINI_API_KEY
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '15'))
+GEMINI_RETRIES = int(os.environ.get('GEMINI_RETRIES', '2'))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '16'))
+RETRY_BASE_DELAY = 0.5
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def _payload(prompt):
+    return {"contents": [{"parts": [{"text": prompt}]}]}
+
+def _extract_text(data):
+    return data['candidates'][0]['content']['parts'][0]['text']
+
+def _retry_after(value, attempt):
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return RETRY_BASE_DELAY * (2 ** (attempt + 1))
+
+def _backoff(attempt):
+    # full jitter: تأخیر تصادفی بین صفر و سقف نمایی، تا تلاش‌های مجدد هم‌زمان پخش شوند
+    return random.uniform(0, RETRY_BASE_DELAY * (2 ** attempt))
+
+class GeminiClient:
+    """کلاینت همگام با requests.Session مشترک، تلاش مجدد با تأخیر تصادفی و محدودیت هم‌زمانی."""
+    def __init__(self, url=GEMINI_URL, timeout=GEMINI_TIMEOUT, retries=GEMINI_RETRIES, max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self.url, self.timeout, self.retries = url, timeout, retries
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.headers.update(HEADERS)
+
+    def generate(self, prompt, priority=rate_limit.INTERACTIVE):
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # توکن تلاش اول را generate() گرفته است؛ هر تلاش مجدد هم یک درخواست HTTP است
+                rate_limit.limiter.acquire(priority, deadline)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try:
+                with self._semaphore:
+                    response = self._session.post(self.url, json=_payload(prompt), timeout=remaining)
+                metrics.GEMINI_RESPONSES.inc(status=str(response.status_code))
+                if response.status_code == 200:
+                    return _extract_text(response.json())
+                if response.status_code == 429:
+                    # تلاش مجدد فوری فقط فشار را بیشتر می‌کند؛ محدودکننده متوقف و پیام به تحلیلگر محلی سپرده می‌شود
+                    rate_limit.limiter.penalize(_retry_after(response.headers.get('Retry-After'), attempt))
+                    raise rate_limit.RateLimited('429')
+                print(f"❌ Gemini API Error: {response.status_code} - {response.text}")
+                if response.status_code not in RETRYABLE_STATUS: return None
+            except rate_limit.RateLimited:
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.GEMINI_RESPONSES.inc(status='error')
+                print(f"❌ Gemini Error: {e}")
+            except Exception as e:
+                metrics.GEMINI_RESPONSES.inc(status='error')
+                print(f"❌ Gemini Error: {e}")
+                return None
+            if attempt < self.retries:
+                time.sleep(min(_backoff(attempt), max(deadline - time.monotonic(), 0)))
+        return None
+
+    def close(self):
+        self._session.close()
+
+class AsyncGeminiClient:
+    """کلاینت ناهمگام روی یک aiohttp.ClientSession با اتصال‌های keep-alive؛ باید داخل event loop ساخته و start شود."""
+    def __init__(self, url=GEMINI_URL, timeout=GEMINI_TIMEOUT, retries=GEMINI_RETRIES, max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self.url, self.timeout, self.retries = url, timeout, retries
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._semaphore = None
+
+    async def start(self):
+        import aiohttp
+        self._aiohttp = aiohttp
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector, headers=HEADERS)
+
+    async def generate(self, prompt, priority=rate_limit.INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await rate_limit.limiter.acquire_async(priority, time.monotonic() + (deadline - loop.time()))
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try:
+                async with self._semaphore:
+                    async with self._session.post(self.url, json=_payload(prompt), timeout=self._aiohttp.ClientTimeout(total=remaining)) as response:
+                        metrics.GEMINI_RESPONSES.inc(status=str(response.status))
+                        if response.status == 200:
+                            return _extract_text(await response.json(content_type=None))
+                        if response.status == 429:
+                            rate_limit.limiter.penalize(_retry_after(response.headers.get('Retry-After'), attempt))
+                            raise rate_limit.RateLimited('429')
+                        print(f"❌ Gemini API Error: {response.status} - {await response.text()}")
+                        if response.status not in RETRYABLE_STATUS: return None
+            except rate_limit.RateLimited:
+                raise
+            except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.GEMINI_RESPONSES.inc(status='error')
+                print(f"❌ Gemini Error: {e!r}")
+            except Exception as e:
+                metrics.GEMINI_RESPONSES.inc(status='error')
+                print(f"❌ Gemini Error: {e!r}")
+                return None
+            if attempt < self.retries:
+                await asyncio.sleep(min(_backoff(attempt), max(deadline - loop.time(), 0)))
+        return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+# ------------------ ACTIVE CLIENT ------------------
+# در حالت webhook استخراج هزینه از متن پیام با generate_async مستقیماً روی event loop منتظر پاسخ می‌ماند.
+# فراخوانی‌های همگامی که در تردهای کارگر می‌مانند (مثل دسته‌بندی ردیف‌های صورت‌حساب) درخواستشان روی همان
+# event loop زمان‌بندی می‌شود تا همه از یک استخر اتصال aiohttp استفاده کنند.
+_sync_client = None
+_async_client = None
+_async_loop = None
+_client_lock = threading.Lock()
+
+def use_async_client(client, loop):
+    global _async_client, _async_loop
+    _async_client, _async_loop = client, loop
+
+def clear_async_client():
+    global _async_client, _async_loop
+    _async_client, _async_loop = None, None
+
+def _get_sync_client():
+    global _sync_client
+    with _client_lock:
+        if _sync_client is None:
+            _sync_client = GeminiClient()
+        return _sync_client
+
+def generate(prompt, priority=rate_limit.INTERACTIVE, deadline=None):
+    """
+    متن پاسخ Gemini را برمی‌گرداند یا در صورت خطا None. اگر محدودکننده تا deadline (زمان monotonic؛
+    پیش‌فرض GEMINI_QUEUE_TIMEOUT ثانیه‌ی بعد) نوبت ندهد یا Gemini پاسخ 429 بدهد RateLimited بلند می‌شود.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + rate_limit.GEMINI_QUEUE_TIMEOUT
+    rate_limit.limiter.acquire(priority, deadline)
+    stats.count('gemini_calls')
+    with metrics.timer(metrics.GEMINI_SECONDS):
+        text = _generate(prompt, priority)
+    if text is None:
+        stats.count('gemini_errors')
+    return text
+
+async def generate_async(prompt, priority=rate_limit.INTERACTIVE, deadline=None):
+    """همان generate برای کد روی event loop حالت webhook؛ منتظر ماندن برای توکن و پاسخ تردی را نگه نمی‌دارد."""
+    if deadline is None:
+        deadline = time.monotonic() + rate_limit.GEMINI_QUEUE_TIMEOUT
+    await rate_limit.limiter.acquire_async(priority, deadline)
+    stats.count('gemini_calls')
+    with metrics.timer(metrics.GEMINI_SECONDS):
+        if _async_client is not None:
+            text = await _async_client.generate(prompt, priority)
+        else:
+            text = await asyncio.get_running_loop().run_in_executor(None, _get_sync_client().generate, prompt, priority)
+    if text is None:
+        stats.count('gemini_errors')
+    return text
+
+def _generate(prompt, priority):
+    if _async_client is not None:
+        future = asyncio.run_coroutine_threadsafe(_async_client.generate(prompt, priority), _async_loop)
+        try:
+            return future.result(timeout=GEMINI_TIMEOUT + 1)
+        except rate_limit.RateLimited:
+            raise
+        except Exception as e:
+            future.cancel()
+            print(f"❌ Gemini Error: {e!r}")
+            return None
+    return _get_sync_client().generate(prompt, priority)
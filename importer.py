@@ -0,0 +1,224 @@
+import codecs
+import csv
+import io
+import os
+from collections import Counter
+from itertools import islice
+from datetime import date, datetime, time
+import jdatetime
+import stats
+import storage
+from expense_parser import CATEGORIES, DEFAULT_CATEGORY, classify_note, normalize_amount
+from extraction import classify_notes
+
+# ------------------ STATEMENT IMPORT ------------------
+# صورت‌حساب بانکی (یا خروجی خود ربات) در قالب CSV/XLSX ردیف‌به‌ردیف خوانده می‌شود؛ ستون‌ها از روی سرستون
+# شناسایی می‌شوند. ردیف‌ها در تکه‌های IMPORT_CHUNK_ROWS تایی پردازش می‌شوند: دسته‌ی هر ردیف از ستون دسته، طبقه‌بند
+# محلی یا (برای توضیحات ناشناخته‌ی همان تکه) درخواست‌های دسته‌ای Gemini تعیین می‌شود و ردیف‌های جدید تکه در یک
+# تراکنش با executemany ثبت می‌شوند. تکراری بودن فقط نسبت به هزینه‌های از قبل موجود سنجیده می‌شود: اگر کلید
+# (مبلغ، زمان، توضیحات) n بار در دیتابیس باشد، n ردیف اول فایل با آن کلید رد می‌شوند و بقیه (مثلاً دو قهوه‌ی یکسان
+# در یک روز، در صورت‌حسابی که ستون ساعت ندارد) ثبت می‌شوند. اگر وارد کردن وسط کار قطع شود، ارسال دوباره‌ی همان فایل
+# تکه‌های ثبت‌شده را تکراری تشخیص می‌دهد.
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', str(10 * 1024 * 1024)))
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '20000'))
+IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS', '2000'))
+FORMATS = ('csv', 'xlsx')
+
+# کلیدواژه‌های سرستون هر فیلد؛ به ترتیب بررسی می‌شوند (timestamp باید پیش از time بیاید)
+HEADER_ALIASES = {
+    'date': ('timestamp', 'date', 'تاریخ'),
+    'time': ('time', 'ساعت', 'زمان'),
+    'debit': ('debit', 'withdrawal', 'برداشت', 'بدهکار'),
+    'credit': ('credit', 'deposit', 'واریز', 'بستانکار'),
+    'amount': ('amount', 'مبلغ'),
+    'note': ('note', 'description', 'شرح', 'توضیحات', 'بابت'),
+    'category': ('category', 'دسته'),
+}
+PERSIAN_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')
+
+class ImportFormatError(Exception):
+    pass
+
+def detect_format(file_name):
+    extension = os.path.splitext(file_name or '')[1].lower().lstrip('.')
+    return extension if extension in FORMATS else None
+
+# ------------------ READERS ------------------
+def _csv_encoding(data):
+    # فایل‌های اکسل فارسی قدیمی معمولاً با cp1256 ذخیره شده‌اند
+    try:
+        codecs.getincrementaldecoder('utf-8-sig')().decode(data[:65536], final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp1256'
+
+def _iter_csv(data):
+    text = io.TextIOWrapper(io.BytesIO(data), encoding=_csv_encoding(data), newline='')
+    sample = text.read(8192)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(text, dialect)
+
+def _iter_xlsx(data):
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+READERS = {'csv': _iter_csv, 'xlsx': _iter_xlsx}
+
+# ------------------ ROW PARSING ------------------
+def _normalize_header(cell):
+    return str(cell or '').strip().lower().replace('‌', ' ')
+
+def _match_columns(row):
+    """اگر ردیف سرستون باشد {فیلد: اندیس ستون} و در غیر این صورت None."""
+    columns = {}
+    for index, cell in enumerate(row):
+        header = _normalize_header(cell)
+        if not header: continue
+        for field, aliases in HEADER_ALIASES.items():
+            if field not in columns and any(alias in header for alias in aliases):
+                columns[field] = index
+                break
+    if 'date' in columns and ('amount' in columns or 'debit' in columns):
+        return columns
+    return None
+
+def _parse_time(value):
+    if isinstance(value, time):
+        return value
+    # ساعت‌های تک‌رقمی صورت‌حساب‌ها (9:05) صفرپر می‌شوند؛ کسر ثانیه‌ی خروجی خود ربات را fromisoformat می‌خواند
+    clock, dot, fraction = str(value).translate(PERSIAN_DIGITS).strip().partition('.')
+    return time.fromisoformat(':'.join(part.strip().zfill(2) for part in clock.split(':')) + dot + fraction)
+
+def parse_timestamp(value, time_value=None):
+    """تاریخ شمسی (۱۴۰۳/۰۵/۲۱) یا میلادی، با یا بدون ساعت، به datetime میلادی؛ در صورت نامعتبر بودن None."""
+    try:
+        if isinstance(value, datetime):
+            parsed = value
+        elif isinstance(value, date):
+            parsed = datetime.combine(value, time.min)
+        else:
+            text = str(value).translate(PERSIAN_DIGITS).strip().replace('T', ' ')
+            date_part, _, time_part = text.partition(' ')
+            year, month, day = (int(part) for part in date_part.replace('-', '/').split('/'))
+            day_value = jdatetime.date(year, month, day).togregorian() if year < 1700 else date(year, month, day)
+            parsed = datetime.combine(day_value, _parse_time(time_part) if time_part.strip() else time.min)
+        if time_value not in (None, '') and parsed.time() == time.min:
+            parsed = datetime.combine(parsed.date(), _parse_time(time_value))
+        return parsed
+    except (TypeError, ValueError):
+        return None
+
+def parse_amount(value, rial=False):
+    if isinstance(value, (int, float)):
+        amount = float(value)
+    else:
+        amount = normalize_amount(str(value or '').strip().replace('−', '-').replace('٬', ','))
+    if not amount:
+        return None
+    # صورت‌حساب‌هایی که برداشت را منفی نشان می‌دهند
+    amount = abs(amount)
+    return amount / 10 if rial else amount
+
+def _cell(row, columns, field):
+    index = columns.get(field)
+    return row[index] if index is not None and index < len(row) else None
+
+def iter_statement_rows(fmt, data, counts):
+    """ردیف‌های معتبر را به شکل (timestamp, amount, note, category یا None) تولید و بقیه را در counts می‌شمارد."""
+    columns = None
+    for row in READERS[fmt](data):
+        if columns is None:
+            columns = _match_columns(row)
+            if columns is not None:
+                header = [_normalize_header(cell) for cell in row]
+                rial = 'ریال' in header[columns.get('debit', columns.get('amount'))]
+            continue
+        if not any(value not in (None, '') for value in row):
+            continue
+        if counts['rows'] >= IMPORT_MAX_ROWS:
+            counts['truncated'] = True
+            break
+        counts['rows'] += 1
+        if 'debit' in columns:
+            amount = parse_amount(_cell(row, columns, 'debit'), rial)
+            if amount is None and parse_amount(_cell(row, columns, 'credit'), rial):
+                counts['credits'] += 1; continue
+        else:
+            amount = parse_amount(_cell(row, columns, 'amount'), rial)
+        timestamp = parse_timestamp(_cell(row, columns, 'date'), _cell(row, columns, 'time'))
+        if amount is None or timestamp is None:
+            counts['invalid'] += 1; continue
+        category = str(_cell(row, columns, 'category') or '').strip()
+        yield timestamp, amount, str(_cell(row, columns, 'note') or '').strip(), category if category in CATEGORIES else None
+    if columns is None:
+        raise ImportFormatError('header not found')
+
+# ------------------ IMPORT ------------------
+def _existing_counts(user_id, start, end):
+    """تعداد هزینه‌های موجود با هر کلید (مبلغ، زمان، توضیحات) در بازه‌ی [start, end]."""
+    rows = storage.fetchall(f"SELECT amount, timestamp, note FROM {storage.ALL_EXPENSES} WHERE user_id = ? AND timestamp >= ? AND timestamp <= ?", (user_id, start, end))
+    return Counter((amount, storage.to_datetime(timestamp), note or '') for amount, timestamp, note in rows)
+
+def _import_chunk(user_id, chunk, counts, seen_keys, ai_categories):
+    existing = _existing_counts(user_id, min(row[0] for row in chunk), max(row[0] for row in chunk))
+    # هزینه‌هایی که تکه‌های قبلی همین فایل ثبت کرده یا با ردیفی از فایل جفت کرده‌اند دوباره حساب نمی‌شوند
+    existing.subtract(seen_keys)
+    rows, unknown = [], set()
+    for timestamp, amount, note, category in chunk:
+        key = (amount, timestamp, note)
+        seen_keys[key] += 1
+        if existing[key] > 0:
+            existing[key] -= 1
+            counts['duplicates'] += 1; continue
+        if category is None:
+            if not note:
+                category = DEFAULT_CATEGORY
+            elif note in ai_categories:
+                category = ai_categories[note] or DEFAULT_CATEGORY
+            else:
+                category, confident = classify_note(note)
+                if not confident:
+                    # بعد از جمع شدن توضیحات ناشناخته‌ی تکه، یک‌جا از Gemini پرسیده می‌شود
+                    category = None
+                    unknown.add(note)
+        rows.append([timestamp, amount, note, category])
+
+    if unknown:
+        notes = sorted(unknown)
+        classified = dict(zip(notes, classify_notes(notes)))
+        ai_categories.update(classified)
+        for row in rows:
+            if row[3] is None:
+                row[3] = classified.get(row[2]) or DEFAULT_CATEGORY
+        counts['ai_classified'] += sum(1 for category in classified.values() if category)
+
+    if not rows:
+        return
+    with storage.transaction() as cursor:
+        cursor.executemany("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)",
+                           [(user_id, amount, category, note, timestamp) for timestamp, amount, note, category in rows])
+        storage.apply_expense_deltas(cursor, user_id, ((timestamp, category, amount) for timestamp, amount, note, category in rows))
+        stats.expenses_added(cursor, len(rows))
+    counts['inserted'] += len(rows)
+
+def import_statement(user_id, fmt, data):
+    """
+    فایل صورت‌حساب را برای کاربر وارد می‌کند و شمارش‌ها را برمی‌گرداند:
+    rows، inserted، duplicates، invalid، credits (ردیف‌های واریز)، ai_classified و truncated.
+    """
+    counts = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'credits': 0, 'ai_classified': 0, 'truncated': False}
+    rows = iter_statement_rows(fmt, data, counts)
+    seen_keys, ai_categories = Counter(), {}
+    while True:
+        chunk = list(islice(rows, IMPORT_CHUNK_ROWS))
+        if not chunk:
+            return counts
+        _import_chunk(user_id, chunk, counts, seen_keys, ai_categories)
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import storage
+from expense_parser import extract_amount, normalize_text
+
+# ------------------ LLM RESPONSE CACHE ------------------
+# پاسخ هوش مصنوعی (دسته و توضیحات) برای متن نرمال‌شده‌ی پیام ذخیره می‌شود؛ مبلغ از کلید حذف شده
+# و هنگام استفاده دوباره از خود پیام خوانده می‌شود، پس «۳۵۰۰۰ ناهار» و «40 هزار ناهار» یک کلید دارند.
+# لایه‌ی اول یک LRU در حافظه و لایه‌ی دوم جدول llm_cache در SQLite است.
+LLM_CACHE_MEMORY_SIZE = int(os.environ.get('LLM_CACHE_MEMORY_SIZE', '2000'))
+LLM_CACHE_MAX_ROWS = int(os.environ.get('LLM_CACHE_MAX_ROWS', '50000'))
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_DAYS', '30')) * 86400
+PRUNE_EVERY_PUTS = 200
+AMOUNT_PLACEHOLDER = '__amount__'
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_puts_since_prune = 0
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0}
+
+def cache_key(text):
+    """کلید کش: مبلغ با یک جانگهدار عوض می‌شود، ارقام فارسی لاتین و فاصله‌ها یکی می‌شوند."""
+    _, match = extract_amount(text)
+    if match is None:
+        return None
+    text = text[:match.start()] + f' {AMOUNT_PLACEHOLDER} ' + text[match.end():]
+    text = text.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')).lower()
+    return ' '.join(normalize_text(text).split())
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+def _remember(key, value):
+    with _lock:
+        _memory[key] = value
+        _memory.move_to_end(key)
+        while len(_memory) > LLM_CACHE_MEMORY_SIZE:
+            _memory.popitem(last=False)
+
+def get(text):
+    """اگر پاسخی برای این پیام در کش باشد دیکشنری {'amount', 'category', 'note'} و در غیر این صورت None برمی‌گرداند."""
+    amount, _ = extract_amount(text)
+    key = cache_key(text)
+    if key is None:
+        return None
+    now = time.time()
+    with _lock:
+        value = _memory.get(key)
+        if value is not None and now - value[2] < LLM_CACHE_TTL_SECONDS:
+            _memory.move_to_end(key)
+            _stats['memory_hits'] += 1
+            return {'amount': amount, 'category': value[0], 'note': value[1]}
+        if value is not None:
+            del _memory[key]
+    row = storage.fetchone("SELECT category, note, created_at FROM llm_cache WHERE cache_key = ?", (key,))
+    if row and now - row[2] < LLM_CACHE_TTL_SECONDS:
+        _remember(key, row)
+        _count('db_hits')
+        return {'amount': amount, 'category': row[0], 'note': row[1]}
+    _count('misses')
+    return None
+
+def put(text, amount, category, note):
+    """
+    پاسخ هوش مصنوعی را ذخیره می‌کند؛ فقط وقتی که مبلغ پیدا شده توسط هوش مصنوعی با مبلغ داخل متن یکی باشد،
+    چون در غیر این صورت جایگذاری مبلغ در دفعات بعد قابل اعتماد نیست.
+    """
+    global _puts_since_prune
+    local_amount, _ = extract_amount(text)
+    key = cache_key(text)
+    if key is None or local_amount != amount:
+        return False
+    value = (category, note, time.time())
+    storage.execute("INSERT OR REPLACE INTO llm_cache (cache_key, category, note, created_at) VALUES (?, ?, ?, ?)", (key, *value))
+    _remember(key, value)
+    with _lock:
+        _stats['stores'] += 1
+        _puts_since_prune += 1
+        should_prune = _puts_since_prune >= PRUNE_EVERY_PUTS
+        if should_prune:
+            _puts_since_prune = 0
+    if should_prune:
+        prune()
+    return True
+
+def prune():
+    """ردیف‌های منقضی و مازاد بر LLM_CACHE_MAX_ROWS (قدیمی‌ترها) را از جدول حذف می‌کند."""
+    with storage.transaction() as cursor:
+        cursor.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - LLM_CACHE_TTL_SECONDS,))
+        cursor.execute("""
+            DELETE FROM llm_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (LLM_CACHE_MAX_ROWS,))
+
+def cache_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['memory_size'] = len(_memory)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    stats['hit_rate'] = ((stats['memory_hits'] + stats['db_hits']) / lookups) * 100 if lookups else 0
+    return stats
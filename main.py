@@ -1,98 +1,47 @@
 import os
-import telebot
-from telebot import types
-import requests
+from telebot import types, apihelper
 from dotenv import load_dotenv
+load_dotenv()  # ماژول‌های پروژه تنظیماتشان را هنگام import از محیط می‌خوانند
 import json
-import sqlite3
+from io import BytesIO
 from datetime import datetime, timedelta
 import jdatetime
-from collections import defaultdict
-import pandas as pd
-import matplotlib
-matplotlib.use('Agg')  # ✅ باید قبل از pyplot باشد
-import matplotlib.pyplot as plt
-from io import BytesIO
+import storage
+import export
+import archive
+import importer
+import charts
+from dispatcher import DispatchingTeleBot
+import llm_cache
+import metrics
+import sessions
+from rate_limit import RateLimited
+import stats
+from extraction import clean_response, extract_expense
+from expense_parser import normalize_amount, parse_expense, parser_stats
 
 # ------------------ ENV & BOT SETUP ------------------
-load_dotenv()
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
-GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 ADMIN_USER_ID = int(os.environ.get('ADMIN_USER_ID'))
+# برای تست محلی می‌توان به جای api.telegram.org یک سرور ساختگی داد
+if os.environ.get('TELEGRAM_API_URL'):
+    apihelper.API_URL = os.environ['TELEGRAM_API_URL'].rstrip('/') + '/bot{0}/{1}'
 
-GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
-HEADERS = {'Content-Type': 'application/json', 'x-goog-api-key': GEMINI_API_KEY}
-
-bot = telebot.TeleBot(BOT_TOKEN)
+# دستورهایی که فایل یا نمودار می‌سازند یا کل دیتابیس را می‌خوانند در مسیر دستورهای سبک اجرا نمی‌شوند
+bot = DispatchingTeleBot(BOT_TOKEN, slow_commands=('export', 'chart', 'archive', 'profile', 'verifytotals'))
 
 # ------------------ DATABASE INIT ------------------
 def init_db():
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL, category TEXT NOT NULL, note TEXT, timestamp DATETIME NOT NULL)')
-    cursor.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT, join_date DATETIME NOT NULL, last_seen_shamsi_month INTEGER DEFAULT 0)')
-    cursor.execute('CREATE TABLE IF NOT EXISTS budgets (user_id INTEGER NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL, amount REAL NOT NULL, last_alert INTEGER DEFAULT 0, PRIMARY KEY (user_id, year, month))')
-    cursor.execute('CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, last_expense_id INTEGER, edit_state_json TEXT)')
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN last_seen_shamsi_month INTEGER DEFAULT 0')
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
-    conn.close()
-    print("✅ Database initialized")
+    version = storage.migrate()
+    print(f"✅ Database initialized (schema v{version})")
 
 # ------------------ HELPERS ------------------
-def normalize_amount(text_amount):
-    if not text_amount: return None
-    persian_to_latin = str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')
-    text = text_amount.translate(persian_to_latin).replace('تومان', '').replace('تومن', '').replace('ریال', '').replace(',', '').strip()
-    multiplier = 1
-    if 'میلیون' in text:
-        multiplier = 1_000_000
-        text = text.replace('میلیون', '').strip()
-    elif 'هزار' in text:
-        multiplier = 1_000
-        text = text.replace('هزار', '').strip()
-    try:
-        return float(text) * multiplier
-    except ValueError:
-        return None
-
-def call_gemini_api(prompt):
-    try:
-        payload = {"contents": [{"parts": [{"text": prompt}]}]}
-        response = requests.post(GEMINI_URL, headers=HEADERS, json=payload, timeout=15)
-        if response.status_code == 200:
-            return response.json()['candidates'][0]['content']['parts'][0]['text']
-        else:
-            print(f"❌ Gemini API Error: {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        print(f"❌ Gemini Error: {e}")
-        return None
-
-def get_user_state(cursor, user_id):
-    cursor.execute("SELECT last_expense_id, edit_state_json FROM user_state WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    if result:
-        edit_state = json.loads(result[1]) if result[1] else None
-        return {'last_expense_id': result[0], 'edit_state': edit_state}
-    return {'last_expense_id': None, 'edit_state': None}
+def get_user_state(user_id):
+    session = sessions.get_session(user_id)
+    return {'last_expense_id': session.last_expense_id, 'edit_state': session.edit_state}
 
 def set_user_state(user_id, last_expense_id="UNCHANGED", edit_state="UNCHANGED"):
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    current_state = get_user_state(cursor, user_id)
-    final_last_expense_id = current_state['last_expense_id'] if last_expense_id == "UNCHANGED" else last_expense_id
-    final_edit_state_json = json.dumps(current_state['edit_state']) if edit_state == "UNCHANGED" else (json.dumps(edit_state) if edit_state else None)
-    cursor.execute("""
-        INSERT INTO user_state (user_id, last_expense_id, edit_state_json) VALUES (?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            last_expense_id = excluded.last_expense_id,
-            edit_state_json = excluded.edit_state_json
-    """, (user_id, final_last_expense_id, final_edit_state_json))
-    conn.commit()
-    conn.close()
+    sessions.update_state(user_id, last_expense_id=last_expense_id, edit_state=edit_state)
 
 def get_shamsi_month_range(j_year, j_month):
     """
@@ -106,6 +55,30 @@ def get_shamsi_month_range(j_year, j_month):
     
     return start_of_month_j.togregorian(), end_of_month_j.togregorian()
 
+def parse_shamsi_date(text):
+    """تاریخ شمسی به شکل 1404/05/01 یا ۱۴۰۴-۰۵-۰۱ را به jdatetime.date تبدیل می‌کند (ValueError در صورت نامعتبر بودن)."""
+    parts = text.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹', '0123456789')).replace('-', '/').split('/')
+    if len(parts) != 3:
+        raise ValueError(text)
+    return jdatetime.date(*(int(part) for part in parts))
+
+def parse_shamsi_range(args):
+    """
+    صفر، یک یا دو تاریخ شمسی را به بازه‌ی میلادی [شروع، پایان) تبدیل می‌کند؛ روز پایان هم جزو بازه است.
+    بدون تاریخ (None, None) برمی‌گرداند و با یک تاریخ فقط همان روز را.
+    """
+    if not args:
+        return None, None
+    if len(args) > 2:
+        raise ValueError(args)
+    start_j = parse_shamsi_date(args[0])
+    end_j = parse_shamsi_date(args[1]) if len(args) == 2 else start_j
+    start = datetime.combine(start_j.togregorian(), datetime.min.time())
+    end = datetime.combine(end_j.togregorian(), datetime.min.time()) + timedelta(days=1)
+    if end <= start:
+        raise ValueError(args)
+    return start, end
+
 def check_for_new_shamsi_month(user_id):
     """
     ✅ --- FEATURE ENHANCEMENT ---
@@ -113,11 +86,7 @@ def check_for_new_shamsi_month(user_id):
     اگر شروع شده باشد، گزارش ماه قبل را ارسال کرده و کاربر را برای تنظیم بودجه جدید راهنمایی می‌کند.
     """
     current_shamsi_month = jdatetime.datetime.now().month
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_seen_shamsi_month FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    last_seen_month = result[0] if result else 0
+    last_seen_month = sessions.get_session(user_id).last_seen_shamsi_month
 
     if last_seen_month != 0 and last_seen_month != current_shamsi_month:
         j_now = jdatetime.datetime.now()
@@ -126,14 +95,11 @@ def check_for_new_shamsi_month(user_id):
         last_month_j_month = j_now.month - 1 if j_now.month > 1 else 12
         
         last_month_j_date = jdatetime.datetime(last_month_j_year, last_month_j_month, 1)
-        start_g, end_g = get_shamsi_month_range(last_month_j_year, last_month_j_month)
 
         # گرفتن بودجه و هزینه‌های ماه گذشته
-        cursor.execute("SELECT amount FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, last_month_j_year, last_month_j_month))
-        last_month_budget_data = cursor.fetchone()
+        last_month_budget_data = storage.fetchone("SELECT amount FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, last_month_j_year, last_month_j_month))
         
-        cursor.execute("SELECT SUM(amount) FROM expenses WHERE user_id = ? AND timestamp >= ? AND timestamp < ?", (user_id, start_g, end_g))
-        last_month_spent = cursor.fetchone()[0] or 0
+        last_month_spent = storage.get_monthly_total(user_id, last_month_j_year, last_month_j_month)
         
         report_message = f"📅 ماه **{last_month_j_date.strftime('%B')}** به پایان رسید!\n\n✨ **خلاصه عملکرد شما:**\n"
         if last_month_budget_data:
@@ -150,10 +116,7 @@ def check_for_new_shamsi_month(user_id):
         
     # در هر صورت، ماه دیده شده را به‌روزرسانی کن
     if last_seen_month != current_shamsi_month:
-        cursor.execute("UPDATE users SET last_seen_shamsi_month = ? WHERE user_id = ?", (current_shamsi_month, user_id))
-        conn.commit()
-
-    conn.close()
+        sessions.mark_month_seen(user_id, current_shamsi_month)
 
 def check_budget_alerts(user_id):
     """
@@ -161,17 +124,11 @@ def check_budget_alerts(user_id):
     هشدارها را بر اساس بازه زمانی دقیق ماه شمسی بررسی می‌کند.
     """
     j_now = jdatetime.datetime.now()
-    start_g, end_g = get_shamsi_month_range(j_now.year, j_now.month)
-    
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("SELECT amount, last_alert FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, j_now.year, j_now.month))
-    budget_data = cursor.fetchone()
-    if not budget_data: conn.close(); return
+    budget_data = storage.fetchone("SELECT amount, last_alert FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, j_now.year, j_now.month))
+    if not budget_data: return
     budget_amount, last_alert = budget_data
     
-    cursor.execute("SELECT SUM(amount) FROM expenses WHERE user_id = ? AND timestamp >= ? AND timestamp < ?", (user_id, start_g, end_g))
-    total_spent = cursor.fetchone()[0] or 0
+    total_spent = storage.get_monthly_total(user_id, j_now.year, j_now.month)
     percentage = (total_spent / budget_amount) * 100 if budget_amount > 0 else 0
     alert_msg = None
     new_alert = last_alert
@@ -188,18 +145,16 @@ def check_budget_alerts(user_id):
     
     if alert_msg:
         bot.send_message(user_id, alert_msg)
-        cursor.execute("UPDATE budgets SET last_alert = ? WHERE user_id = ? AND year = ? AND month = ?", (new_alert, user_id, j_now.year, j_now.month))
-        conn.commit()
-        
-    conn.close()
+        storage.execute("UPDATE budgets SET last_alert = ? WHERE user_id = ? AND year = ? AND month = ?", (new_alert, user_id, j_now.year, j_now.month))
 
 def save_expense(user_id, amount, category, note):
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)", (user_id, amount, category, note, datetime.now()))
-    expense_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with storage.transaction() as cursor:
+        timestamp = datetime.now()
+        cursor.execute("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)", (user_id, amount, category, note, timestamp))
+        expense_id = cursor.lastrowid
+        storage.apply_expense_delta(cursor, user_id, timestamp, category, amount, 1)
+        stats.expenses_added(cursor)
+    charts.invalidate(user_id)
     set_user_state(user_id, last_expense_id=expense_id, edit_state=None)
     output_message = (f"✅ هزینه ثبت شد:\n\n💰 **مبلغ:** {amount:,.0f} تومان\n📂 **دسته:** {category}\n📝 **توضیحات:** {note}")
     bot.send_message(user_id, output_message, parse_mode='Markdown')
@@ -211,13 +166,12 @@ def save_expense(user_id, amount, category, note):
 def send_welcome(message):
     user = message.from_user
     try:
-        conn = sqlite3.connect('expenses.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
-        if cursor.fetchone() is None:
-            cursor.execute("INSERT INTO users (user_id, first_name, username, join_date, last_seen_shamsi_month) VALUES (?, ?, ?, ?, ?)", (user.id, user.first_name, user.username, datetime.now(), 0)) # ثبت اولیه با 0
-            conn.commit()
-        conn.close()
+        with storage.transaction() as cursor:
+            cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
+            if cursor.fetchone() is None:
+                cursor.execute("INSERT INTO users (user_id, first_name, username, join_date, last_seen_shamsi_month) VALUES (?, ?, ?, ?, ?)", (user.id, user.first_name, user.username, datetime.now(), 0)) # ثبت اولیه با 0
+                stats.user_registered(cursor)
+                sessions.forget(user.id)
     except Exception as e:
         print(f"❌ Error registering user: {e}")
     
@@ -230,27 +184,20 @@ def send_welcome(message):
 *دستورات اصلی:*
 📊 *گزارش روزانه:* /reportdaily
 📅 *گزارش هفتگی:* /reportweekly
+🗓️ *گزارش بازه دلخواه:* /report
+⚖️ *مقایسه با ماه قبل:* /compare
 💰 *تنظیم بودجه:* /setbudget
 📈 *وضعیت بودجه:* /budget
 ↩️ *آخرین تراکنش:* /undo
-📤 *خروجی اکسل و نمودار:* /export
+📤 *خروجی اکسل/CSV و نمودار:* /export
+📥 *وارد کردن صورت‌حساب:* فایل CSV یا XLSX را بفرستید
+📉 *نمودار روند ماهانه/روزانه:* /chart
 🗑️ *پاک کردن سوابق:* /reset
 ℹ️ *راهنما:* /help
 """
     bot.reply_to(message, welcome_text, parse_mode='Markdown')
 
-@bot.message_handler(commands=['reportdaily', 'reportweekly'])
-def handle_report(message):
-    check_for_new_shamsi_month(message.from_user.id)
-    user_id = message.from_user.id
-    period = 'weekly' if 'weekly' in message.text else 'daily'
-    title = "📅 گزارش هفتگی شما" if period == 'weekly' else "📊 گزارش روزانه شما"
-    date_filter = "timestamp >= DATE('now', 'localtime', '-6 days')" if period == 'weekly' else "DATE(timestamp) = DATE('now', 'localtime')"
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND {date_filter} GROUP BY category ORDER BY SUM(amount) DESC", (user_id,))
-    results = cursor.fetchall()
-    conn.close()
+def send_category_report(user_id, title, results):
     if not results:
         bot.send_message(user_id, "هیچ هزینه‌ای در این بازه ثبت نشده است."); return
     total_spent = sum(item[1] for item in results)
@@ -260,6 +207,57 @@ def handle_report(message):
     report_text += f"\n💰 *مجموع:* `{total_spent:,.0f}` تومان"
     bot.send_message(user_id, report_text, parse_mode='Markdown')
 
+@bot.message_handler(commands=['reportdaily', 'reportweekly'])
+def handle_report(message):
+    check_for_new_shamsi_month(message.from_user.id)
+    user_id = message.from_user.id
+    period = 'weekly' if 'weekly' in message.text else 'daily'
+    title = "📅 گزارش هفتگی شما" if period == 'weekly' else "📊 گزارش روزانه شما"
+    today = datetime.now().date()
+    start = today - timedelta(days=6) if period == 'weekly' else today
+    send_category_report(user_id, title, storage.category_totals_between(user_id, start, today + timedelta(days=1)))
+
+@bot.message_handler(commands=['report'])
+def handle_range_report(message):
+    """
+    گزارش دسته‌ای برای یک بازه‌ی دلخواه شمسی.
+    استفاده: /report 1404/05/01 1404/05/31  (با یک تاریخ، فقط همان روز)
+    """
+    check_for_new_shamsi_month(message.from_user.id)
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    try:
+        start, end = parse_shamsi_range(args)
+    except ValueError:
+        start = None
+    if start is None:
+        bot.send_message(user_id, "❌ بازه را به شکل `/report 1404/05/01 1404/05/31` وارد کنید.", parse_mode='Markdown'); return
+    title = f"🗓️ گزارش {' تا '.join(args)}"
+    send_category_report(user_id, title, storage.category_totals_between(user_id, start.date(), end.date()))
+
+@bot.message_handler(commands=['compare'])
+def handle_compare(message):
+    """مقایسه‌ی هزینه‌های هر دسته در ماه شمسی جاری (تا امروز) با کل ماه قبل."""
+    check_for_new_shamsi_month(message.from_user.id)
+    user_id = message.from_user.id
+    j_now = jdatetime.datetime.now()
+    prev_year, prev_month = (j_now.year, j_now.month - 1) if j_now.month > 1 else (j_now.year - 1, 12)
+    this_start, this_end = get_shamsi_month_range(j_now.year, j_now.month)
+    prev_start, prev_end = get_shamsi_month_range(prev_year, prev_month)
+    this_month = dict(storage.category_totals_between(user_id, this_start.date(), this_end.date()))
+    prev_month_totals = dict(storage.category_totals_between(user_id, prev_start.date(), prev_end.date()))
+    if not this_month and not prev_month_totals:
+        bot.send_message(user_id, "هیچ هزینه‌ای در این دو ماه ثبت نشده است."); return
+    prev_name = jdatetime.date(prev_year, prev_month, 1).strftime('%B')
+    report_text = f"*📊 مقایسه {j_now.strftime('%B')} (تا امروز) با {prev_name}*\n\n"
+    for category in sorted(this_month.keys() | prev_month_totals.keys(), key=lambda c: -this_month.get(c, 0)):
+        current, previous = this_month.get(category, 0), prev_month_totals.get(category, 0)
+        change = f"{((current - previous) / previous) * 100:+.0f}٪" if previous else "جدید"
+        report_text += f"📂 {category}: `{current:,.0f}` ← `{previous:,.0f}` ({change})\n"
+    current_total, previous_total = sum(this_month.values()), sum(prev_month_totals.values())
+    report_text += f"\n💰 *مجموع:* `{current_total:,.0f}` ← `{previous_total:,.0f}` تومان"
+    bot.send_message(user_id, report_text, parse_mode='Markdown')
+
 @bot.message_handler(commands=['setbudget'])
 def handle_set_budget(message):
     check_for_new_shamsi_month(message.from_user.id)
@@ -268,10 +266,7 @@ def handle_set_budget(message):
         amount = normalize_amount(parts[1])
         if amount and amount > 0:
             j_now = jdatetime.datetime.now()
-            conn = sqlite3.connect('expenses.db', check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO budgets (user_id, year, month, amount, last_alert) VALUES (?, ?, ?, ?, 0)", (message.from_user.id, j_now.year, j_now.month, amount))
-            conn.commit(); conn.close()
+            storage.execute("INSERT OR REPLACE INTO budgets (user_id, year, month, amount, last_alert) VALUES (?, ?, ?, ?, 0)", (message.from_user.id, j_now.year, j_now.month, amount))
             bot.reply_to(message, f"✅ بودجه ماه {j_now.strftime('%B')} روی {amount:,.0f} تومان تنظیم شد.")
         else:
             bot.reply_to(message, f"❌ مبلغ '{parts[1]}' نامعتبر است.")
@@ -279,14 +274,12 @@ def handle_set_budget(message):
         msg = bot.reply_to(message, "بودجه این ماه چقدر باشد؟ 💰 (فقط عدد را ارسال کنید)")
         bot.register_next_step_handler(msg, process_budget_amount)
 
+@metrics.timed_handler
 def process_budget_amount(message):
     amount = normalize_amount(message.text)
     if amount and amount > 0:
         j_now = jdatetime.datetime.now()
-        conn = sqlite3.connect('expenses.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO budgets (user_id, year, month, amount, last_alert) VALUES (?, ?, ?, ?, 0)", (message.from_user.id, j_now.year, j_now.month, amount))
-        conn.commit(); conn.close()
+        storage.execute("INSERT OR REPLACE INTO budgets (user_id, year, month, amount, last_alert) VALUES (?, ?, ?, ?, 0)", (message.from_user.id, j_now.year, j_now.month, amount))
         bot.reply_to(message, f"✅ بودجه ماه {j_now.strftime('%B')} روی {amount:,.0f} تومان تنظیم شد.")
     else:
         msg = bot.reply_to(message, "❌ ورودی نامعتبر است. دوباره فقط مبلغ را ارسال کنید.")
@@ -301,20 +294,13 @@ def handle_budget_status(message):
     check_for_new_shamsi_month(message.from_user.id)
     user_id = message.from_user.id
     j_now = jdatetime.datetime.now()
-    start_g, end_g = get_shamsi_month_range(j_now.year, j_now.month)
-    
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute("SELECT amount FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, j_now.year, j_now.month))
-    budget_data = cursor.fetchone()
+    budget_data = storage.fetchone("SELECT amount FROM budgets WHERE user_id = ? AND year = ? AND month = ?", (user_id, j_now.year, j_now.month))
 
     if not budget_data:
-        bot.reply_to(message, "هنوز بودجه‌ای برای این ماه تنظیم نکرده‌ای. با `/setbudget` بساز."); conn.close(); return
+        bot.reply_to(message, "هنوز بودجه‌ای برای این ماه تنظیم نکرده‌ای. با `/setbudget` بساز."); return
 
     budget_amount = budget_data[0]
-    cursor.execute("SELECT SUM(amount) FROM expenses WHERE user_id = ? AND timestamp >= ? AND timestamp < ?", (user_id, start_g, end_g))
-    total_spent = cursor.fetchone()[0] or 0
-    conn.close()
+    total_spent = storage.get_monthly_total(user_id, j_now.year, j_now.month)
     
     remaining = budget_amount - total_spent
     percentage = (total_spent / budget_amount) * 100 if budget_amount > 0 else 0
@@ -325,41 +311,61 @@ def handle_budget_status(message):
 
 @bot.message_handler(commands=['export'])
 def handle_export(message):
+    """
+    خروجی هزینه‌ها به همراه نمودار دسته‌بندی.
+    استفاده: /export [xlsx|csv|parquet] [از تاریخ شمسی] [تا تاریخ شمسی]  مثلا: /export csv 1404/01/01 1404/03/31
+    """
     check_for_new_shamsi_month(message.from_user.id)
     user_id = message.from_user.id
-    bot.send_message(user_id, "در حال آماده‌سازی خروجی اکسل و نمودار... ⚙️")
+    args = message.text.split()[1:]
+    fmt = args.pop(0).lower() if args and args[0].lower() in export.FORMATS else 'xlsx'
     try:
-        conn = sqlite3.connect('expenses.db', check_same_thread=False)
-        df = pd.read_sql_query("SELECT timestamp, amount, category, note FROM expenses WHERE user_id = ?", conn, params=(user_id,))
-        conn.close()
-        if df.empty:
+        start, end = parse_shamsi_range(args)
+    except ValueError:
+        bot.send_message(user_id, "❌ بازه نامعتبر است. مثال: `/export csv 1404/01/01 1404/03/31`", parse_mode='Markdown'); return
+    bot.send_message(user_id, "در حال آماده‌سازی خروجی و نمودار... ⚙️")
+    try:
+        export_file, row_count = export.export_expenses(user_id, fmt, start, end)
+        if export_file is None:
             bot.send_message(user_id, "هیچ داده‌ای برای خروجی وجود ندارد."); return
-        excel_buffer = BytesIO()
-        df.to_excel(excel_buffer, index=False, sheet_name='Expenses'); excel_buffer.seek(0)
-        bot.send_document(user_id, ('expenses.xlsx', excel_buffer), caption="خروجی اکسل")
-        category_totals = df.groupby('category')['amount'].sum()
-        plt.style.use('seaborn-v0_8-pastel')
-        fig, ax = plt.subplots(figsize=(10, 8))
-        ax.pie(category_totals, labels=category_totals.index, autopct='%1.1f%%', startangle=90); ax.axis('equal')
-        plt.title('توزیع هزینه‌ها')
-        chart_buffer = BytesIO(); plt.savefig(chart_buffer, format='PNG', bbox_inches='tight'); plt.close(fig)
-        chart_buffer.seek(0)
-        bot.send_photo(user_id, photo=chart_buffer, caption="نمودار توزیع هزینه‌ها")
+        with export_file:
+            bot.send_document(user_id, (f'expenses.{fmt}', export_file), caption=f"خروجی {fmt} ({row_count} ردیف)")
+        bot.send_photo(user_id, photo=charts.render_chart(user_id, 'pie', start, end), caption="نمودار توزیع هزینه‌ها")
+    except export.ExportFormatUnavailable:
+        bot.send_message(user_id, f"❌ خروجی {fmt} روی این سرور در دسترس نیست.")
     except Exception as e:
         print(f"❌ Export Error: {e}")
         bot.send_message(user_id, "خطا در تولید خروجی.")
 
+@bot.message_handler(commands=['chart'])
+def handle_chart(message):
+    """
+    نمودار هزینه‌ها. استفاده: /chart [pie|monthly|daily]
+    pie: توزیع دسته‌ها، monthly: روند ۱۲ ماه اخیر، daily: هزینه‌ی روزانه‌ی ماه جاری
+    """
+    check_for_new_shamsi_month(message.from_user.id)
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    chart_type = args[0].lower() if args else 'monthly'
+    if chart_type not in charts.CHART_TYPES:
+        bot.send_message(user_id, f"❌ نوع نمودار نامعتبر است. یکی از این‌ها: {', '.join(charts.CHART_TYPES)}"); return
+    try:
+        png = charts.render_chart(user_id, chart_type)
+        if png is None:
+            bot.send_message(user_id, "هیچ داده‌ای برای نمودار وجود ندارد."); return
+        bot.send_photo(user_id, photo=png)
+    except Exception as e:
+        print(f"❌ Chart Error: {e}")
+        bot.send_message(user_id, "خطا در رسم نمودار.")
+
 @bot.message_handler(commands=['undo'])
 def handle_undo(message):
     check_for_new_shamsi_month(message.from_user.id)
     user_id = message.from_user.id
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    user_state = get_user_state(cursor, user_id)
+    user_state = get_user_state(user_id)
     expense_id = user_state.get('last_expense_id')
     if expense_id:
-        cursor.execute("SELECT amount, category, note FROM expenses WHERE id = ?", (expense_id,))
-        expense_data = cursor.fetchone()
+        expense_data = storage.fetchone("SELECT amount, category, note FROM expenses WHERE id = ?", (expense_id,))
         if expense_data:
             markup = types.InlineKeyboardMarkup()
             markup.add(types.InlineKeyboardButton("✏️ ویرایش", callback_data=f'edit|{expense_id}'),
@@ -368,7 +374,6 @@ def handle_undo(message):
             bot.send_message(user_id, f"آخرین هزینه: `{expense_data[0]:,.0f} تومان - {expense_data[1]}`", reply_markup=markup, parse_mode='Markdown')
         else: bot.send_message(user_id, "این هزینه قبلاً حذف شده است.")
     else: bot.send_message(user_id, "هیچ هزینه اخیری برای مدیریت وجود ندارد.")
-    conn.close()
 
 @bot.message_handler(commands=['reset'])
 def handle_reset(message):
@@ -383,25 +388,107 @@ def show_stats(message):
         bot.send_message(message.chat.id, "⛔ شما اجازه دسترسی به این بخش را ندارید.")
         return
     try:
-        conn = sqlite3.connect('expenses.db', check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM expenses")
-        total_expenses = cursor.fetchone()[0]
-        cursor.execute("SELECT DATE(join_date), COUNT(*) FROM users GROUP BY DATE(join_date) ORDER BY DATE(join_date) DESC LIMIT 5")
-        daily_new_users = cursor.fetchall()
-        conn.close()
-
-        stats_text = f"📊 **آمار کلی ربات**\n\n👥 **کل کاربران:** {total_users}\n🧾 **کل هزینه‌ها:** {total_expenses}\n\n--- **کاربران جدید روزانه** ---\n"
-        for date, count in daily_new_users:
-            stats_text += f"🗓️ {date}: {count} کاربر جدید\n"
+        totals, days = stats.read_stats(days=5)
+        local_parser = parser_stats()
+        response_cache = llm_cache.cache_stats()
+
+        stats_text = f"📊 **آمار کلی ربات**\n\n👥 **کل کاربران:** {totals.get('users', 0)}\n🧾 **کل هزینه‌ها:** {totals.get('expenses', 0)}\n\n--- **آمار روزانه** ---\n"
+        for day, counters in days:
+            if not counters: continue
+            # سهم پیام‌های هزینه که به هوش مصنوعی ارجاع شدند
+            handled = counters.get('local_parsed', 0) + counters.get('llm_cache_hits', 0) + counters.get('gemini_fallbacks', 0)
+            fallback_rate = (counters.get('gemini_fallbacks', 0) / handled) * 100 if handled else 0
+            stats_text += (f"🗓️ {day}: 🆕 {counters.get('new_users', 0)} | 🙋 فعال {counters.get('active_users', 0)} | 💬 {counters.get('messages', 0)} پیام\n"
+                           f"    🧾 +{counters.get('expenses_added', 0)}/-{counters.get('expenses_deleted', 0)} | 🤖 Gemini {counters.get('gemini_calls', 0)} (خطا {counters.get('gemini_errors', 0)})"
+                           f" | ↪️ ارجاع {fallback_rate:.0f}٪ | ⚠️ خطای تحلیل {counters.get('parse_failures', 0)} | 🚦 محدودشده {counters.get('rate_limited', 0)}\n")
+        parsed_total = local_parser['hits'] + local_parser['misses']
+        hit_rate = (local_parser['hits'] / parsed_total) * 100 if parsed_total else 0
+        stats_text += f"\n--- **تحلیلگر محلی** ---\n⚡ ثبت بدون هوش مصنوعی: {local_parser['hits']}\n🤖 ارجاع به هوش مصنوعی: {local_parser['misses']}\n🎯 نرخ موفقیت: {hit_rate:.1f}٪\n"
+        stats_text += (f"\n--- **کش پاسخ هوش مصنوعی** ---\n"
+                       f"🧠 حافظه: {response_cache['memory_hits']} | 💾 دیتابیس: {response_cache['db_hits']} | ❌ عدم وجود: {response_cache['misses']}\n"
+                       f"🎯 نرخ برخورد: {response_cache['hit_rate']:.1f}٪ ({response_cache['memory_size']} مورد در حافظه)\n")
 
         bot.send_message(message.chat.id, stats_text, parse_mode='Markdown')
     except Exception as e:
         print(f"❌ Error fetching stats: {e}")
         bot.send_message(message.chat.id, "خطا در دریافت آمار.")
 
+@bot.message_handler(commands=['profile'])
+def handle_profile(message):
+    """
+    پروفایلر نمونه‌بردار را برای چند ثانیه روشن می‌کند (فقط ادمین) و در پایان پرتکرارترین توابع و
+    فایل پشته‌های collapsed (ورودی flamegraph) را می‌فرستد. استفاده: /profile [ثانیه]
+    """
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.send_message(message.chat.id, "⛔ شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    chat_id = message.chat.id
+    args = message.text.split()[1:]
+    duration = int(args[0]) if args and args[0].isdigit() else 30
+
+    def send_profile(samples, stacks):
+        top = '\n'.join(f"{count}  {frame}" for frame, count in metrics.top_functions(stacks))
+        bot.send_message(chat_id, f"🔬 نتیجه‌ی پروفایل ({samples} نمونه):\n\n{top or 'همه‌ی تردها بیکار بودند.'}")
+        collapsed = '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+        bot.send_document(chat_id, ('profile.folded', BytesIO(collapsed.encode())), caption="پشته‌های collapsed برای flamegraph")
+
+    if metrics.start_profiler(duration, send_profile):
+        bot.send_message(chat_id, f"🔬 پروفایلر برای {min(duration, metrics.PROFILE_MAX_SECONDS)} ثانیه روشن شد.")
+    else:
+        bot.send_message(chat_id, "پروفایلر در حال اجراست.")
+
+@bot.message_handler(commands=['archive'])
+def handle_archive(message):
+    """
+    هزینه‌های سال‌های شمسی بسته‌شده را به فایل‌های آرشیو منتقل می‌کند (فقط ادمین).
+    با `/archive vacuum` بعد از انتقال، فضای جدول اصلی هم آزاد می‌شود.
+    """
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.send_message(message.chat.id, "⛔ شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    try:
+        moved = {j_year: count for j_year, count in archive.archive_closed_years().items() if count}
+        if 'vacuum' in message.text.split()[1:]:
+            archive.vacuum()
+        if not moved:
+            bot.send_message(message.chat.id, f"📦 داده‌ی جدیدی برای آرشیو نبود. آرشیوهای موجود: {', '.join(map(str, storage.archive_years())) or 'هیچ'}")
+            return
+        report_text = "📦 آرشیو انجام شد:\n\n" + "\n".join(f"🗓️ {j_year}: {count:,} ردیف" for j_year, count in moved.items())
+        bot.send_message(message.chat.id, report_text)
+    except Exception as e:
+        print(f"❌ Archive Error: {e}")
+        bot.send_message(message.chat.id, "خطا در آرشیو هزینه‌ها.")
+
+@bot.message_handler(commands=['verifytotals'])
+def handle_verify_totals(message):
+    """
+    جمع‌های ماهانه و روزانه‌ی ذخیره‌شده را با جدول expenses مقایسه می‌کند (فقط ادمین).
+    با `/verifytotals fix` هر دو جدول از نو ساخته می‌شوند.
+    """
+    if message.from_user.id != ADMIN_USER_ID:
+        bot.send_message(message.chat.id, "⛔ شما اجازه دسترسی به این بخش را ندارید.")
+        return
+    try:
+        if 'fix' in message.text.split()[1:]:
+            with storage.transaction() as cursor:
+                monthly_rows = storage.rebuild_monthly_totals(cursor)
+                daily_rows = storage.rebuild_daily_totals(cursor)
+            bot.send_message(message.chat.id, f"🔧 جدول‌های جمع از نو ساخته شدند ({monthly_rows} ردیف ماهانه، {daily_rows} ردیف روزانه).")
+            return
+        drift = storage.verify_monthly_totals()
+        daily_drift = storage.verify_daily_totals()
+        if not drift and not daily_drift:
+            bot.send_message(message.chat.id, "✅ جمع‌های ماهانه و روزانه با هزینه‌ها هم‌خوانی دارند.")
+            return
+        report_text = f"⚠️ {len(drift)} ردیف ماهانه و {daily_drift} ردیف روزانه‌ی ناهم‌خوان پیدا شد:\n\n"
+        for (user_id, j_year, j_month), (stored_total, stored_count), (real_total, real_count) in drift[:10]:
+            report_text += f"👤 {user_id} - {j_year}/{j_month}: ذخیره‌شده `{stored_total:,.0f}` ({stored_count}) ≠ واقعی `{real_total:,.0f}` ({real_count})\n"
+        report_text += "\nبرای اصلاح: /verifytotals fix"
+        bot.send_message(message.chat.id, report_text, parse_mode='Markdown')
+    except Exception as e:
+        print(f"❌ Error verifying monthly totals: {e}")
+        bot.send_message(message.chat.id, "خطا در بررسی جمع‌های ماهانه.")
+
 # ------------------ CALLBACKS ------------------
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback_query(call):
@@ -409,18 +496,26 @@ def handle_callback_query(call):
     parts = call.data.split('|'); action = parts[0]
     if action == 'reset_confirm':
         if parts[1] == 'yes':
-            conn = sqlite3.connect('expenses.db', check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM expenses WHERE user_id = ?", (user_id,))
-            cursor.execute("DELETE FROM budgets WHERE user_id = ?", (user_id,))
-            conn.commit(); conn.close()
+            with storage.transaction() as cursor:
+                deleted = storage.delete_user_expenses(cursor, user_id)
+                stats.expenses_deleted(cursor, deleted)
+                cursor.execute("DELETE FROM budgets WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM monthly_totals WHERE user_id = ?", (user_id,))
+                cursor.execute("DELETE FROM daily_category_totals WHERE user_id = ?", (user_id,))
+            charts.invalidate(user_id)
             bot.edit_message_text("🗑️ تمام سوابق مالی شما پاک شد.", chat_id, call.message.message_id)
         else:
             bot.edit_message_text("👍 عملیات پاک‌سازی لغو شد.", chat_id, call.message.message_id)
     elif action == 'delete':
         expense_id = int(parts[1])
-        conn = sqlite3.connect('expenses.db', check_same_thread=False)
-        cursor = conn.cursor(); cursor.execute("DELETE FROM expenses WHERE id = ? AND user_id = ?", (expense_id, user_id)); conn.commit(); conn.close()
+        with storage.transaction() as cursor:
+            cursor.execute("SELECT amount, timestamp, category FROM expenses WHERE id = ? AND user_id = ?", (expense_id, user_id))
+            expense_data = cursor.fetchone()
+            if expense_data:
+                cursor.execute("DELETE FROM expenses WHERE id = ? AND user_id = ?", (expense_id, user_id))
+                storage.apply_expense_delta(cursor, user_id, expense_data[1], expense_data[2], -expense_data[0], -1)
+                stats.expenses_deleted(cursor)
+        charts.invalidate(user_id)
         bot.edit_message_text("✅ هزینه با موفقیت حذف شد.", chat_id, call.message.message_id)
     elif action == 'edit':
         expense_id = int(parts[1])
@@ -437,11 +532,10 @@ def handle_callback_query(call):
     elif action == 'cancel_edit':
         bot.edit_message_text("👍 عملیات لغو شد.", chat_id, call.message.message_id)
 
+@metrics.timed_handler
 def process_edit_step(message):
     user_id = message.from_user.id
-    conn = sqlite3.connect('expenses.db', check_same_thread=False)
-    cursor = conn.cursor()
-    state = get_user_state(cursor, user_id).get('edit_state')
+    state = get_user_state(user_id).get('edit_state')
     if state:
         expense_id, field = state['expense_id'], state['field']
         new_value = message.text
@@ -452,41 +546,139 @@ def process_edit_step(message):
                 if not new_value or new_value <= 0:
                     bot.send_message(user_id, "مبلغ نامعتبر است."); new_value = None
             if new_value is not None:
-                cursor.execute(f"UPDATE expenses SET {field} = ? WHERE id = ? AND user_id = ?", (new_value, expense_id, user_id))
-                conn.commit(); bot.send_message(user_id, "✅ هزینه ویرایش شد.")
+                with storage.transaction() as cursor:
+                    cursor.execute("SELECT amount, timestamp, category FROM expenses WHERE id = ? AND user_id = ?", (expense_id, user_id))
+                    old_data = cursor.fetchone()
+                    cursor.execute(f"UPDATE expenses SET {field} = ? WHERE id = ? AND user_id = ?", (new_value, expense_id, user_id))
+                    if old_data and field in ('amount', 'category'):
+                        old_amount, timestamp, old_category = old_data
+                        new_amount = new_value if field == 'amount' else old_amount
+                        new_category = new_value if field == 'category' else old_category
+                        storage.apply_expense_delta(cursor, user_id, timestamp, old_category, -old_amount, -1)
+                        storage.apply_expense_delta(cursor, user_id, timestamp, new_category, new_amount, 1)
+                charts.invalidate(user_id)
+                bot.send_message(user_id, "✅ هزینه ویرایش شد.")
         else: bot.send_message(user_id, "فیلد نامعتبر است.")
         set_user_state(user_id, edit_state=None)
-    conn.close()
+
+# ------------------ STATEMENT IMPORT ------------------
+@bot.message_handler(content_types=['document'])
+def handle_document(message):
+    """صورت‌حساب CSV/XLSX را یک‌جا وارد می‌کند؛ هشدار بودجه فقط یک بار در پایان بررسی می‌شود."""
+    check_for_new_shamsi_month(message.from_user.id)
+    user_id = message.from_user.id
+    document = message.document
+    fmt = importer.detect_format(document.file_name)
+    if fmt is None:
+        bot.send_message(user_id, "❌ فقط فایل‌های CSV و XLSX قابل وارد کردن هستند."); return
+    if document.file_size and document.file_size > importer.IMPORT_MAX_BYTES:
+        bot.send_message(user_id, f"❌ حجم فایل بیشتر از {importer.IMPORT_MAX_BYTES // (1024 * 1024)} مگابایت است."); return
+    bot.send_message(user_id, "در حال خواندن صورت‌حساب... ⏳")
+    try:
+        data = bot.download_file(bot.get_file(document.file_id).file_path)
+        result = importer.import_statement(user_id, fmt, data)
+    except importer.ImportFormatError:
+        bot.send_message(user_id, "❌ سرستون‌های فایل شناخته نشد. فایل باید ستون‌های «تاریخ» و «مبلغ» (یا «برداشت») و ترجیحاً «شرح» داشته باشد."); return
+    except Exception as e:
+        print(f"❌ Import Error: {e}")
+        bot.send_message(user_id, "خطا در وارد کردن فایل."); return
+    if result['inserted']:
+        charts.invalidate(user_id)
+    report_text = (f"📥 *نتیجه‌ی وارد کردن صورت‌حساب*\n\n"
+                   f"✅ ثبت‌شده: {result['inserted']}\n"
+                   f"♻️ تکراری: {result['duplicates']}\n"
+                   f"💳 واریز (نادیده گرفته شد): {result['credits']}\n"
+                   f"⚠️ نامعتبر: {result['invalid']}\n"
+                   f"🤖 دسته‌بندی با هوش مصنوعی: {result['ai_classified']}")
+    if result['truncated']:
+        report_text += f"\n\n✂️ فقط {importer.IMPORT_MAX_ROWS} ردیف اول خوانده شد."
+    bot.send_message(user_id, report_text, parse_mode='Markdown')
+    if result['inserted']:
+        check_budget_alerts(user_id)
 
 # ------------------ TEXT MESSAGE HANDLER ------------------
-@bot.message_handler(func=lambda m: True)
-def handle_text_message(message):
+# هندلر در دو بخش همگام (پیش و پس از Gemini) نوشته شده تا حالت webhook بتواند بین آن‌ها پاسخ Gemini را روی
+# event loop منتظر بماند، بی‌آنکه تردی نگه داشته شود.
+def prepare_text_expense(message):
+    """
+    بخش پیش از Gemini: اگر پیام بدون هوش مصنوعی رسیدگی شد (False, None) و در غیر این صورت
+    (True, تحلیل محلی نامطمئن یا None) برمی‌گرداند.
+    """
     if message.text.startswith('/'):
-        bot.reply_to(message, "دستور نامشخص است. برای راهنمایی /help را ارسال کنید."); return
-    
+        bot.reply_to(message, "دستور نامشخص است. برای راهنمایی /help را ارسال کنید."); return False, None
+
     check_for_new_shamsi_month(message.from_user.id)
+
+    # پیام‌های ساده بدون رفت و برگشت به هوش مصنوعی ثبت می‌شوند
+    parsed = parse_expense(message.text)
+    if parsed and parsed['confident']:
+        stats.count('local_parsed')
+        save_expense(message.from_user.id, parsed['amount'], parsed['category'], parsed['note']); return False, None
+
+    cached = llm_cache.get(message.text)
+    if cached:
+        stats.count('llm_cache_hits')
+        save_expense(message.from_user.id, cached['amount'], cached['category'], cached['note']); return False, None
+
     bot.send_chat_action(message.chat.id, 'typing')
-    
-    prompt = f'Extract from "{message.text}" into JSON: {{"amount": number, "category": "string", "note": "string"}}. Categories: غذا, حمل و نقل, خرید, تفریح, قبوض, سلامتی, آموزش, هدیه, اجاره, سایر. Example: "۳۲۰۰۰ قهوه" -> {{"amount": 32000, "category": "غذا", "note": "قهوه"}}. Only JSON.'
-    ai_response = call_gemini_api(prompt)
+    stats.count('gemini_fallbacks')
+    return True, parsed
+
+def finish_text_expense(message, parsed, ai_response, rate_limited=False):
+    """بخش پس از Gemini: پاسخ هوش مصنوعی (یا رد شدن توسط محدودکننده) را ثبت و به کاربر اعلام می‌کند."""
+    if rate_limited:
+        # به جای انتظار پشت صف Gemini، تحلیل محلی (هرچند نامطمئن) ثبت می‌شود
+        stats.count('rate_limited')
+        if parsed:
+            save_expense(message.from_user.id, parsed['amount'], parsed['category'], parsed['note'])
+            bot.send_message(message.chat.id, "⚡ سرویس هوش مصنوعی شلوغ است؛ دسته‌بندی تقریبی انجام شد. در صورت نیاز با /undo حذف و دوباره ارسال کنید.")
+        else:
+            bot.send_message(message.chat.id, "⏳ سرویس هوش مصنوعی در حال حاضر شلوغ است. لطفاً کمی بعد دوباره تلاش کنید یا هزینه را در قالب «مبلغ شرح» بفرستید. مثلا: `35000 ناهار`", parse_mode='Markdown')
+        return
     if not ai_response:
         bot.send_message(message.chat.id, "❌ خطا در ارتباط با هوش مصنوعی. لطفاً دوباره تلاش کنید."); return
     try:
-        clean_response = ai_response.strip().replace("```json", "").replace("```", "").strip()
-        expense_data = json.loads(clean_response)
+        expense_data = json.loads(clean_response(ai_response))
         amount, category, note = expense_data.get('amount'), expense_data.get('category', 'سایر'), expense_data.get('note', '')
         if amount and isinstance(amount, (int, float)) and amount > 0:
+            llm_cache.put(message.text, amount, category, note)
             save_expense(message.from_user.id, amount, category, note)
         else:
             bot.send_message(message.chat.id, "🤔 مبلغ معتبری برای ثبت پیدا نشد. لطفاً در قالب 'مبلغ شرح هزینه' ارسال کنید. مثلا: `35000 ناهار`")
     except json.JSONDecodeError:
+        stats.count('parse_failures')
+        metrics.JSON_PARSE_FAILURES.inc()
         bot.send_message(message.chat.id, f"❌ خطا در تحلیل پاسخ هوش مصنوعی. لطفاً تراکنش را با فرمت دیگری بیان کنید.\nپاسخ دریافت شده:\n`{ai_response}`", parse_mode='Markdown')
     except Exception as e:
         print(f"❌ Error in handle_text_message: {e}")
         bot.send_message(message.chat.id, "خطای پیش‌بینی نشده‌ای رخ داد. لطفاً دوباره تلاش کنید.")
 
+@bot.message_handler(func=lambda m: True)
+def handle_text_message(message):
+    needs_ai, parsed = prepare_text_expense(message)
+    if not needs_ai:
+        return
+    try:
+        ai_response = extract_expense(message.text, message.from_user.id)
+    except RateLimited:
+        finish_text_expense(message, parsed, None, rate_limited=True); return
+    finish_text_expense(message, parsed, ai_response)
+
+# ------------------ INSTRUMENTATION ------------------
+metrics.instrument_handlers(bot)
+metrics.gauge('jibjib_queue_depth', 'Updates waiting or running in the dispatcher', bot.executor.queue_depth)
+
 # ------------------ MAIN LOOP ------------------
 if __name__ == '__main__':
     print("🚀 Bot starting...")
     init_db()
-    bot.infinity_polling(timeout=60, long_polling_timeout=30)
\ No newline at end of file
+    charts.start()
+    metrics.start_server()
+    try:
+        bot.infinity_polling(timeout=60, long_polling_timeout=30)
+    finally:
+        bot.executor.shutdown()
+        sessions.shutdown()
+        stats.shutdown()
+        charts.shutdown()
+        storage.close_all()
\ No newline at end of file
@@ -0,0 +1,247 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+# ------------------ METRICS ------------------
+# شمارنده‌ها و هیستوگرام‌های درون‌پروسه‌ای برای مسیرهای داغ (هندلرها، SQL، Gemini، خروجی و نمودار) که روی
+# http://METRICS_HOST:METRICS_PORT/metrics با قالب متنی Prometheus در دسترس‌اند. METRICS_PORT=0 سرور را خاموش می‌کند.
+# پروفایلر نمونه‌بردار با دستور ادمین /profile روشن می‌شود و فقط در همان بازه هزینه دارد.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9464'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '10')) / 1000
+PROFILE_MAX_SECONDS = 300
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_registry = {}
+_gauges = {}
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name, self.help_text, self.kind = name, help_text, 'counter'
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] += amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.kind = name, help_text, 'histogram'
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                # [تعداد هر سطل..., مجموع, تعداد کل]
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        samples = []
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', key + (('le', repr(float(bound))),), cumulative))
+            samples.append((f'{self.name}_bucket', key + (('le', '+Inf'),), series[-1]))
+            samples.append((f'{self.name}_sum', key, series[-2]))
+            samples.append((f'{self.name}_count', key, series[-1]))
+        return samples
+
+def counter(name, help_text):
+    with _lock:
+        return _registry.setdefault(name, Counter(name, help_text))
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    with _lock:
+        return _registry.setdefault(name, Histogram(name, help_text, buckets))
+
+def gauge(name, help_text, fn):
+    """مقدار gauge هنگام خواندن /metrics از fn گرفته می‌شود."""
+    with _lock:
+        _gauges[name] = (help_text, fn)
+
+@contextmanager
+def timer(metric, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - started, **labels)
+
+HANDLER_SECONDS = histogram('jibjib_handler_seconds', 'Handler execution time')
+HANDLER_ERRORS = counter('jibjib_handler_errors_total', 'Handlers that raised')
+SQL_SECONDS = histogram('jibjib_sql_seconds', 'SQLite statement execution time (execute/executemany, without fetch)')
+GEMINI_SECONDS = histogram('jibjib_gemini_seconds', 'Gemini generate() time including retries')
+GEMINI_RESPONSES = counter('jibjib_gemini_responses_total', 'Gemini HTTP responses by status (error = no response)')
+EXPORT_SECONDS = histogram('jibjib_export_seconds', 'Export file writing time')
+CHART_SECONDS = histogram('jibjib_chart_seconds', 'Chart rendering time (cache misses only)')
+CHART_CACHE = counter('jibjib_chart_cache_total', 'Chart cache lookups')
+JSON_PARSE_FAILURES = counter('jibjib_json_parse_failures_total', 'Gemini responses that were not valid JSON')
+
+# ------------------ HANDLER INSTRUMENTATION ------------------
+def timed_handler(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=fn.__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=fn.__name__)
+    return wrapper
+
+def instrument_handlers(bot):
+    """همه‌ی هندلرهای ثبت‌شده روی bot را با زمان‌سنج می‌پوشاند؛ بعد از تعریف همه‌ی هندلرها صدا زده شود."""
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            if not hasattr(handler['function'], '__wrapped__'):
+                handler['function'] = timed_handler(handler['function'])
+
+# ------------------ EXPOSITION ------------------
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in key) + '}'
+
+def render():
+    lines = []
+    with _lock:
+        metrics = list(_registry.values())
+        snapshots = [(metric, metric.samples()) for metric in metrics]
+        gauges = list(_gauges.items())
+    for metric, samples in snapshots:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{name}{_format_labels(key)} {value}' for name, key, value in samples)
+    for name, (help_text, fn) in gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"❌ Metrics gauge Error ({name}): {e}")
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+_server = None
+
+def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """سرور /metrics را در یک ترد پس‌زمینه راه می‌اندازد (اگر port صفر نباشد)."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404); return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"❌ Metrics server Error: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='jibjib-metrics', daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{port}/metrics")
+    return _server
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+# ------------------ SAMPLING PROFILER ------------------
+_profiler_lock = threading.Lock()
+_profiling = False
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+def start_profiler(duration, on_done):
+    """
+    به مدت duration ثانیه هر PROFILE_INTERVAL از پشته‌ی همه‌ی تردها نمونه می‌گیرد و در پایان
+    on_done(samples, stacks) را صدا می‌زند؛ stacks شمارش پشته‌ها با قالب collapsed (قابل استفاده در flamegraph) است.
+    اگر پروفایلر از قبل در حال اجرا باشد False برمی‌گرداند.
+    """
+    global _profiling
+    with _profiler_lock:
+        if _profiling:
+            return False
+        _profiling = True
+
+    def run():
+        global _profiling
+        stacks, samples = _Tally(), 0
+        me = threading.get_ident()
+        deadline = time.monotonic() + min(duration, PROFILE_MAX_SECONDS)
+        try:
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != me:
+                        stacks[_collapse(frame)] += 1
+                samples += 1
+                time.sleep(PROFILE_INTERVAL)
+        finally:
+            with _profiler_lock:
+                _profiling = False
+        try:
+            on_done(samples, stacks)
+        except Exception as e:
+            print(f"❌ Profiler Error: {e}")
+
+    threading.Thread(target=run, name='jibjib-profiler', daemon=True).start()
+    return True
+
+# تردهایی که بیکار منتظر کار یا شبکه‌اند در فهرست پرهزینه‌ترین توابع نمی‌آیند
+IDLE_FILES = ('threading.py', 'thread.py', 'queue.py', 'selectors.py', 'socketserver.py')
+
+def top_functions(stacks, limit=15):
+    """پرتکرارترین فریم‌های بالای پشته (self time) به صورت [(فریم، تعداد)]، بدون تردهای بیکار."""
+    leaves = _Tally()
+    for stack, count in stacks.items():
+        leaf = stack.rsplit(';', 1)[-1]
+        if not leaf.startswith(IDLE_FILES):
+            leaves[leaf] += count
+    return leaves.most_common(limit)
@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+# ------------------ GEMINI RATE LIMITER ------------------
+# هر درخواست HTTP به Gemini یک توکن از سطل سراسری (GEMINI_RATE در ثانیه، حداکثر GEMINI_BURST) برمی‌دارد و هر پیام
+# کاربر یک توکن از سطل خود او (GEMINI_USER_RATE در دقیقه). منتظرها به ترتیب اولویت (پیام کاربر پیش از کارهای
+# گروهی مثل وارد کردن صورت‌حساب) و زمان رسیدن نوبت می‌گیرند و تا مهلت خود صبر می‌کنند. RateLimited فقط وقتی بلند
+# می‌شود که توکن تا مهلت درخواست نرسد، صف انتظار از GEMINI_MAX_WAITING بیشتر شود یا کاربر از سهمش گذشته باشد؛
+# آنگاه هندلر به تحلیلگر محلی برمی‌گردد. تلاش‌های مجدد کلاینت Gemini هم هر کدام یک توکن برمی‌دارند.
+# اینکه دستورهای سبک (/budget، /undo و ...) پشت ترافیک هوش مصنوعی صف نکشند کار مسیر دستورها در dispatcher است.
+GEMINI_RATE = float(os.environ.get('GEMINI_RATE', '5'))
+GEMINI_BURST = float(os.environ.get('GEMINI_BURST', '10'))
+GEMINI_USER_RATE = float(os.environ.get('GEMINI_USER_RATE', '20')) / 60
+GEMINI_USER_BURST = float(os.environ.get('GEMINI_USER_BURST', '5'))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get('GEMINI_QUEUE_TIMEOUT', '3'))
+GEMINI_MAX_WAITING = int(os.environ.get('GEMINI_MAX_WAITING', '64'))
+USER_BUCKETS_SIZE = 10000
+
+INTERACTIVE, BULK = 0, 1
+
+RATE_LIMITED = metrics.counter('jibjib_gemini_rate_limited_total', 'Gemini requests refused by the rate limiter')
+
+class RateLimited(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_take(self, now):
+        """اگر توکن باشد برمی‌دارد و 0 برمی‌گرداند، وگرنه چند ثانیه تا توکن بعدی مانده است."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class GeminiLimiter:
+    def __init__(self, rate=GEMINI_RATE, burst=GEMINI_BURST, user_rate=GEMINI_USER_RATE, user_burst=GEMINI_USER_BURST,
+                 max_waiting=GEMINI_MAX_WAITING):
+        self._cond = threading.Condition()
+        self._global = TokenBucket(rate, burst)
+        self._user_rate, self._user_burst = user_rate, user_burst
+        self._users = OrderedDict()
+        self._waiters = []
+        # (loop, asyncio.Event) منتظرهای acquire_async که با تغییر صف باید بیدار شوند
+        self._async_waiters = set()
+        self._seq = itertools.count()
+        self._paused_until = 0
+        self.max_waiting = max_waiting
+
+    def _refuse(self, reason):
+        RATE_LIMITED.inc(reason=reason)
+        raise RateLimited(reason)
+
+    def _user_bucket(self, user_id):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self._user_rate, self._user_burst)
+            if len(self._users) > USER_BUCKETS_SIZE:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return bucket
+
+    def admit(self, user_id):
+        """سهم کاربر برای یک پیام؛ بدون انتظار، یا پذیرفته می‌شود یا RateLimited('user')."""
+        with self._cond:
+            if self._user_bucket(user_id).try_take(time.monotonic()):
+                self._refuse('user')
+
+    def _enqueue(self, priority):
+        """با _cond گرفته‌شده؛ ticket منتظر جدید را در صف اولویت می‌گذارد."""
+        if len(self._waiters) >= self.max_waiting:
+            self._refuse('queue_full')
+        ticket = (priority, next(self._seq))
+        heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _dequeue(self, ticket):
+        self._waiters.remove(ticket)
+        heapq.heapify(self._waiters)
+        self._wake()
+
+    def _wake(self):
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _next_wait(self, ticket, deadline):
+        """
+        با _cond گرفته‌شده: اگر نوبت و توکن ticket رسیده باشد توکن را برمی‌دارد و None برمی‌گرداند،
+        وگرنه حداکثر زمان انتظار تا بررسی دوباره (None یعنی تا بیدار شدن).
+        """
+        now = time.monotonic()
+        paused = max(self._paused_until - now, 0)
+        if self._waiters[0] == ticket:
+            wait = paused or self._global.try_take(now)
+            if not wait:
+                return None
+        else:
+            # تخمین: توکن بعدی + یک توکن برای هر منتظر جلوتر
+            ahead = sum(1 for waiter in self._waiters if waiter < ticket)
+            wait = paused + ahead / self._global.rate
+        if deadline is not None and now + wait > deadline:
+            self._refuse('deadline')
+        if self._waiters[0] == ticket:
+            return wait
+        return float('inf') if deadline is None else deadline - now
+
+    def acquire(self, priority=INTERACTIVE, deadline=None):
+        """
+        تا رسیدن نوبت و توکن سراسری منتظر می‌ماند. deadline زمان monotonic است؛ اگر معلوم باشد توکن
+        تا آن موقع نمی‌رسد، بدون انتظار بیهوده RateLimited بلند می‌شود.
+        """
+        with self._cond:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._next_wait(ticket, deadline)
+                    if wait is None:
+                        return
+                    self._cond.wait(None if wait == float('inf') else wait)
+            finally:
+                self._dequeue(ticket)
+
+    async def acquire_async(self, priority=INTERACTIVE, deadline=None):
+        """همان acquire برای کد روی event loop: انتظار با asyncio انجام می‌شود و نه تردی نگه داشته می‌شود نه loop."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            ticket = self._enqueue(priority)
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._next_wait(ticket, deadline)
+                    if wait is None:
+                        return
+                    waiter[1].clear()
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), None if wait == float('inf') else wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+                self._dequeue(ticket)
+
+    def penalize(self, seconds):
+        """بعد از 429: تا seconds ثانیه هیچ درخواستی فرستاده نمی‌شود و سطل سراسری خالی می‌شود."""
+        RATE_LIMITED.inc(reason='429')
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._global.tokens = 0
+            self._wake()
+
+    def waiting(self):
+        with self._cond:
+            return len(self._waiters)
+
+limiter = GeminiLimiter()
+metrics.gauge('jibjib_gemini_waiting', 'Requests waiting for a Gemini rate limiter token', limiter.waiting)
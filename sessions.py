@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import storage
+
+# ------------------ USER SESSION CACHE ------------------
+# وضعیت هر کاربر (آخرین هزینه، وضعیت ویرایش و آخرین ماه شمسی دیده‌شده) در حافظه نگه داشته می‌شود تا هر پیام
+# برای خواندن آن‌ها به دیتابیس نرود. edit_state بلافاصله نوشته می‌شود (write-through) و بقیه‌ی فیلدها
+# هر SESSION_FLUSH_INTERVAL ثانیه یک‌جا ذخیره می‌شوند (write-behind).
+# جلسه‌ی تغییرکرده‌ای که از کش بیرون رانده می‌شود تا نوشته شدنش در _evicted می‌ماند؛ get_session پیش از خواندن از
+# دیتابیس آنجا را نگاه می‌کند تا مقدار قدیمی (مثلاً ماه شمسی، که خلاصه‌ی ماه را دوباره می‌فرستاد) خوانده نشود.
+# تغییرات فقط روی جلسه‌ای اعمال می‌شوند که همان لحظه در کش است، پس تغییری روی جلسه‌ی بیرون‌رانده‌شده گم نمی‌شود.
+# فرض بر این است که فقط یک پروسه‌ی ربات روی این دیتابیس کار می‌کند.
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '2'))
+
+class UserSession:
+    __slots__ = ('user_id', 'last_expense_id', 'edit_state', 'last_seen_shamsi_month', 'state_dirty', 'month_dirty')
+
+    def __init__(self, user_id, last_expense_id, edit_state, last_seen_shamsi_month):
+        self.user_id = user_id
+        self.last_expense_id = last_expense_id
+        self.edit_state = edit_state
+        self.last_seen_shamsi_month = last_seen_shamsi_month
+        self.state_dirty = False
+        self.month_dirty = False
+
+_lock = threading.RLock()
+# نوشتن snapshotها سریالی است تا یک snapshot قدیمی‌تر روی نوشته‌ی جدیدتر ننشیند
+_write_lock = threading.Lock()
+_sessions = OrderedDict()
+_evicted = {}
+# جلسه‌هایی که snapshotشان گرفته شده ولی هنوز commit نشده‌اند (پرچم dirty آن‌ها پاک است)
+_writing = set()
+_flush_event = threading.Event()
+_flusher = None
+
+def _load(user_id):
+    state = storage.fetchone("SELECT last_expense_id, edit_state_json FROM user_state WHERE user_id = ?", (user_id,))
+    user = storage.fetchone("SELECT last_seen_shamsi_month FROM users WHERE user_id = ?", (user_id,))
+    last_expense_id, edit_state_json = state if state else (None, None)
+    return UserSession(user_id, last_expense_id, json.loads(edit_state_json) if edit_state_json else None, (user[0] or 0) if user else 0)
+
+def _cached(user_id):
+    """جلسه‌ی کش‌شده یا منتظر نوشتن را (با _lock گرفته‌شده) برمی‌گرداند و به انتهای LRU می‌برد."""
+    session = _sessions.get(user_id)
+    if session is not None:
+        _sessions.move_to_end(user_id)
+        return session
+    session = _evicted.pop(user_id, None)
+    if session is not None:
+        _sessions[user_id] = session
+    return session
+
+def _evict():
+    """با _lock گرفته‌شده صدا زده می‌شود؛ جلسه‌های تغییرکرده‌ی بیرون‌رانده‌شده را برمی‌گرداند."""
+    evicted = []
+    while len(_sessions) > SESSION_CACHE_SIZE:
+        user_id, old = _sessions.popitem(last=False)
+        if old.state_dirty or old.month_dirty or old in _writing:
+            _evicted[user_id] = old
+            evicted.append(old)
+    return evicted
+
+def get_session(user_id):
+    with _lock:
+        session = _cached(user_id)
+        if session is not None:
+            evicted = _evict()
+    if session is None:
+        session = _load(user_id)
+        with _lock:
+            # ممکن است ترد دیگری هم‌زمان همین کاربر را بارگذاری (و حتی تغییر داده و بیرون رانده) باشد
+            existing = _cached(user_id)
+            if existing is not None:
+                session = existing
+            else:
+                _sessions[user_id] = session
+            evicted = _evict()
+    if evicted:
+        _persist(evicted)
+    return session
+
+@contextmanager
+def _current_session(user_id):
+    """جلسه‌ی کاربر را در حالی که _lock گرفته شده و جلسه هنوز در کش است در اختیار می‌گذارد."""
+    while True:
+        session = get_session(user_id)
+        with _lock:
+            # بین get_session و گرفتن قفل، ترد دیگری ممکن است این جلسه را بیرون رانده باشد
+            if _sessions.get(user_id) is session:
+                yield session
+                return
+
+def _snapshot(sessions):
+    states, months = [], []
+    for session in sessions:
+        if session.state_dirty:
+            states.append((session.user_id, session.last_expense_id, json.dumps(session.edit_state) if session.edit_state else None))
+            session.state_dirty = False
+        if session.month_dirty:
+            months.append((session.last_seen_shamsi_month, session.user_id))
+            session.month_dirty = False
+    return states, months
+
+def _persist(sessions):
+    with _write_lock:
+        with _lock:
+            states, months = _snapshot(sessions)
+            _writing.update(sessions)
+        try:
+            if states or months:
+                _write(states, months)
+        except Exception:
+            # تغییرات دوباره dirty می‌شوند تا flush بعدی آن‌ها را بنویسد و جلسه‌ی بیرون‌رانده از _evicted حذف نشود
+            state_users, month_users = {row[0] for row in states}, {row[1] for row in months}
+            with _lock:
+                for session in sessions:
+                    session.state_dirty |= session.user_id in state_users
+                    session.month_dirty |= session.user_id in month_users
+            raise
+        finally:
+            with _lock:
+                _writing.difference_update(sessions)
+                for session in sessions:
+                    if _evicted.get(session.user_id) is session and not (session.state_dirty or session.month_dirty):
+                        del _evicted[session.user_id]
+
+def _write(states, months):
+    with storage.transaction() as cursor:
+        cursor.executemany("""
+            INSERT INTO user_state (user_id, last_expense_id, edit_state_json) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_expense_id = excluded.last_expense_id,
+                edit_state_json = excluded.edit_state_json
+        """, states)
+        cursor.executemany("UPDATE users SET last_seen_shamsi_month = ? WHERE user_id = ?", months)
+
+def _schedule_flush():
+    global _flusher
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='jibjib-session-flusher', daemon=True)
+            _flusher.start()
+
+def _flush_loop():
+    while not _flush_event.wait(SESSION_FLUSH_INTERVAL):
+        try:
+            flush()
+        except Exception as e:
+            print(f"❌ Session flush Error: {e}")
+
+def flush():
+    """همه‌ی تغییرات ذخیره‌نشده را در یک تراکنش به دیتابیس می‌نویسد."""
+    with _lock:
+        dirty = [s for s in _sessions.values() if s.state_dirty or s.month_dirty] + list(_evicted.values())
+    _persist(dirty)
+
+def update_state(user_id, last_expense_id="UNCHANGED", edit_state="UNCHANGED"):
+    with _current_session(user_id) as session:
+        # فقط تغییر واقعی edit_state فوراً نوشته می‌شود؛ پاک کردن وضعیتی که از قبل خالی است هزینه‌ای ندارد
+        write_through = edit_state != "UNCHANGED" and edit_state != session.edit_state
+        if last_expense_id != "UNCHANGED":
+            session.last_expense_id = last_expense_id
+        if edit_state != "UNCHANGED":
+            session.edit_state = edit_state
+        session.state_dirty = True
+    if write_through:
+        _persist([session])
+    else:
+        _schedule_flush()
+
+def mark_month_seen(user_id, shamsi_month):
+    with _current_session(user_id) as session:
+        session.last_seen_shamsi_month = shamsi_month
+        session.month_dirty = True
+    _schedule_flush()
+
+def forget(user_id):
+    """جلسه‌ی کاربر را (بعد از ذخیره‌ی تغییراتش) از کش حذف می‌کند تا دفعه‌ی بعد از دیتابیس خوانده شود."""
+    with _lock:
+        session = _sessions.pop(user_id, None) or _evicted.get(user_id)
+        if session is not None and (session.state_dirty or session.month_dirty):
+            _evicted[user_id] = session
+    if session is not None:
+        _persist([session])
+
+def shutdown():
+    _flush_event.set()
+    flush()
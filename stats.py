@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+import storage
+
+# ------------------ GLOBAL STATS ------------------
+# شمارنده‌های /stats در جدول global_stats با سطل‌های روزانه (day, metric) نگه داشته می‌شوند؛ مقدارهای کل
+# (تعداد کاربران و هزینه‌ها) در سطل ویژه‌ی TOTAL هستند، پس خواندن آمار به اندازه‌ی دیتابیس بستگی ندارد.
+# شمارنده‌هایی که به یک نوشتن وابسته‌اند (ثبت‌نام، ثبت و حذف هزینه) در همان تراکنش نوشتن به‌روز می‌شوند.
+# رویدادهای پرتکرار (پیام‌ها، کاربران فعال، فراخوانی‌های Gemini، نتیجه‌ی تحلیل پیام) در حافظه جمع
+# و هر STATS_FLUSH_INTERVAL ثانیه یک‌جا نوشته می‌شوند.
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', '5'))
+TOTAL = 'total'
+
+_lock = threading.Lock()
+_pending = defaultdict(int)
+_active = set()
+_flush_event = threading.Event()
+_flusher = None
+
+def today():
+    return datetime.now().date().isoformat()
+
+def _add(cursor, rows):
+    cursor.executemany("""
+        INSERT INTO global_stats (day, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value
+    """, rows)
+
+# ------------------ WRITE-PATH COUNTERS (transactional) ------------------
+def user_registered(cursor):
+    _add(cursor, [(today(), 'new_users', 1), (TOTAL, 'users', 1)])
+
+def expenses_added(cursor, count=1):
+    if count:
+        _add(cursor, [(today(), 'expenses_added', count), (TOTAL, 'expenses', count)])
+
+def expenses_deleted(cursor, count=1):
+    if count:
+        _add(cursor, [(today(), 'expenses_deleted', count), (TOTAL, 'expenses', -count)])
+
+# ------------------ EVENT COUNTERS (buffered) ------------------
+def count(metric, n=1):
+    with _lock:
+        _pending[(today(), metric)] += n
+    _schedule_flush()
+
+def record_message(user_id):
+    """هر پیام ورودی؛ هر کاربر در هر روز یک بار به کاربران فعال اضافه می‌شود."""
+    day = today()
+    with _lock:
+        _pending[(day, 'messages')] += 1
+        _active.add((day, user_id))
+    _schedule_flush()
+
+def _schedule_flush():
+    global _flusher
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='jibjib-stats-flusher', daemon=True)
+            _flusher.start()
+
+def _flush_loop():
+    while not _flush_event.wait(STATS_FLUSH_INTERVAL):
+        try:
+            flush()
+        except Exception as e:
+            print(f"❌ Stats flush Error: {e}")
+
+def flush():
+    with _lock:
+        pending, active = dict(_pending), set(_active)
+        _pending.clear(); _active.clear()
+    if not pending and not active:
+        return
+    try:
+        with storage.transaction() as cursor:
+            # active_users فقط کاربران امروز را نگه می‌دارد تا بعد از ری‌استارت هم کسی دو بار شمرده نشود
+            cursor.execute("DELETE FROM active_users WHERE day < ?", (today(),))
+            new_active = defaultdict(int)
+            for day, user_id in active:
+                cursor.execute("INSERT OR IGNORE INTO active_users (day, user_id) VALUES (?, ?)", (day, user_id))
+                new_active[day] += cursor.rowcount
+            rows = [(day, metric, value) for (day, metric), value in pending.items()]
+            rows += [(day, 'active_users', value) for day, value in new_active.items() if value]
+            _add(cursor, rows)
+    except Exception:
+        # شمارش‌ها از دست نروند؛ در flush بعدی دوباره تلاش می‌شود
+        with _lock:
+            for key, value in pending.items():
+                _pending[key] += value
+            _active.update(active)
+        raise
+
+def read_stats(days=5):
+    """(مقادیر کل، لیست (روز، شمارنده‌ها) برای days روز اخیر از جدید به قدیم)؛ شمارش‌های ذخیره‌نشده هم لحاظ می‌شوند."""
+    day_list = [(datetime.now().date() - timedelta(days=i)).isoformat() for i in range(days)]
+    rows = storage.fetchall("SELECT day, metric, value FROM global_stats WHERE day = ? OR day >= ?", (TOTAL, day_list[-1]))
+    buckets = defaultdict(lambda: defaultdict(int))
+    for day, metric, value in rows:
+        buckets[day][metric] += value
+    with _lock:
+        for (day, metric), value in _pending.items():
+            buckets[day][metric] += value
+    return dict(buckets[TOTAL]), [(day, dict(buckets[day])) for day in day_list]
+
+def shutdown():
+    _flush_event.set()
+    flush()
@@ -0,0 +1,381 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+import jdatetime
+import metrics
+
+# ------------------ CONNECTION LAYER ------------------
+# هر ترد یک اتصال ماندگار به دیتابیس دارد (sqlite3 اتصال را بین تردها امن به اشتراک نمی‌گذارد)
+# و همه‌ی اتصال‌ها با WAL باز می‌شوند تا خواننده‌ها پشت نویسنده‌ها صف نکشند.
+DB_PATH = os.environ.get('DB_PATH', 'expenses.db')
+DB_CACHE_KB = int(os.environ.get('DB_CACHE_KB', '20000'))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+_archive_generation = 0
+
+def _statement_kind(sql):
+    return sql.lstrip().split(None, 1)[0].upper()
+
+class _TimedCursor(sqlite3.Cursor):
+    """زمان اجرای هر دستور را (بدون زمان fetch) در هیستوگرام jibjib_sql_seconds ثبت می‌کند."""
+    def execute(self, sql, params=()):
+        with metrics.timer(metrics.SQL_SECONDS, statement=_statement_kind(sql)):
+            return super().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        with metrics.timer(metrics.SQL_SECONDS, statement=_statement_kind(sql)):
+            return super().executemany(sql, seq_of_params)
+
+class _TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+def _open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE, factory=_TimedConnection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')  # در WAL فقط در checkpoint فلاش کامل لازم است
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+def get_conn():
+    """اتصال اختصاصی ترد جاری را برمی‌گرداند و در صورت نیاز آن را می‌سازد."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.generation != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.depth = 0
+        _local.generation = _generation
+        _local.archive_generation = -1
+        with _connections_lock:
+            _connections.append(conn)
+    # ATTACH داخل تراکنش مجاز نیست؛ اگر آرشیو جدیدی ساخته شده باشد بیرون از تراکنش به‌روز می‌شود
+    if _local.archive_generation != _archive_generation and _local.depth == 0:
+        _attach_archives(conn)
+    return conn
+
+@contextmanager
+def transaction():
+    """
+    یک تراکنش روی اتصال ترد جاری باز می‌کند و کرسر را برمی‌گرداند.
+    تراکنش‌های تو در تو به تراکنش بیرونی می‌پیوندند و فقط بیرونی‌ترین commit می‌کند.
+    """
+    conn = get_conn()
+    cursor = conn.cursor()
+    _local.depth += 1
+    try:
+        yield cursor
+        if _local.depth == 1:
+            conn.commit()
+    except BaseException:
+        if _local.depth == 1:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth -= 1
+        cursor.close()
+
+def execute(sql, params=()):
+    with transaction() as cursor:
+        cursor.execute(sql, params)
+        return cursor.lastrowid
+
+def fetchone(sql, params=()):
+    return get_conn().execute(sql, params).fetchone()
+
+def fetchall(sql, params=()):
+    return get_conn().execute(sql, params).fetchall()
+
+def close_all():
+    """همه‌ی اتصال‌های باز را (مثلاً هنگام خاموش شدن ربات) می‌بندد."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+
+# ------------------ ARCHIVE ------------------
+# هزینه‌های سال‌های شمسی بسته‌شده به فایل‌های جدای ARCHIVE_DIR/expenses_<سال>.db منتقل می‌شوند (archive.py) و روی
+# هر اتصال با نام archive_<سال> ATTACH می‌شوند. نمای موقت all_expenses اجتماع جدول اصلی و همه‌ی آرشیوهاست و هر
+# خواننده‌ای که کل سابقه را لازم دارد از آن می‌خواند؛ مسیرهای نوشتن فقط با جدول اصلی کار دارند.
+# all_expense_amounts همان اجتماع بدون id و note است. SQLite ستون‌های استفاده‌نشده‌ی نمای UNION ALL را حذف نمی‌کند،
+# پس جمع‌ها (بازسازی جدول‌های جمع، جمع دسته‌ها) از این نمای باریک می‌خوانند تا فقط ایندکس پوشا خوانده شود؛
+# فقط خواننده‌هایی که note لازم دارند (خروجی و تشخیص تکراری در وارد کردن) از all_expenses و جدول می‌خوانند.
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archive'))
+ARCHIVE_FILE = re.compile(r'^expenses_(\d{4})\.db$')
+ALL_EXPENSES = 'all_expenses'
+ALL_EXPENSE_AMOUNTS = 'all_expense_amounts'
+EXPENSE_COLUMNS = 'id, user_id, amount, category, note, timestamp'
+EXPENSE_INDEX_COLUMNS = 'user_id, timestamp, amount, category'
+
+def archive_path(j_year):
+    return os.path.join(ARCHIVE_DIR, f'expenses_{j_year}.db')
+
+def archive_years():
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(ARCHIVE_FILE.match, names) if match)
+
+def attached_archives(conn):
+    return [row[1] for row in conn.execute('PRAGMA database_list') if row[1].startswith('archive_')]
+
+def attach_archive(conn, j_year):
+    schema = f'archive_{j_year}'
+    if schema not in attached_archives(conn):
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(j_year),))
+    return schema
+
+def _attach_archives(conn):
+    sources = ['main.expenses']
+    for j_year in archive_years():
+        try:
+            sources.append(f'{attach_archive(conn, j_year)}.expenses')
+        except sqlite3.OperationalError as e:
+            # مثلاً عبور از سقف SQLITE_MAX_ATTACHED؛ آن سال در نمای یکپارچه دیده نمی‌شود
+            print(f"❌ Archive attach Error ({j_year}): {e}")
+    for view, columns in ((ALL_EXPENSES, EXPENSE_COLUMNS), (ALL_EXPENSE_AMOUNTS, EXPENSE_INDEX_COLUMNS)):
+        conn.execute(f'DROP VIEW IF EXISTS temp.{view}')
+        conn.execute(f'CREATE TEMP VIEW {view} AS ' + ' UNION ALL '.join(f'SELECT {columns} FROM {source}' for source in sources))
+    _local.archive_generation = _archive_generation
+
+def refresh_archives():
+    """بعد از ساخت یا تغییر یک آرشیو صدا زده می‌شود تا هر ترد در استفاده‌ی بعدی، نمای all_expenses خود را از نو بسازد."""
+    global _archive_generation
+    _archive_generation += 1
+
+def create_expense_index(cursor, schema='main'):
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_expenses_user_time ON expenses ({EXPENSE_INDEX_COLUMNS})')
+
+def delete_user_expenses(cursor, user_id):
+    """همه‌ی هزینه‌های کاربر را از جدول اصلی و آرشیوها حذف می‌کند و تعداد ردیف‌های حذف‌شده را برمی‌گرداند."""
+    deleted = cursor.execute("DELETE FROM main.expenses WHERE user_id = ?", (user_id,)).rowcount
+    for schema in attached_archives(cursor.connection):
+        deleted += cursor.execute(f"DELETE FROM {schema}.expenses WHERE user_id = ?", (user_id,)).rowcount
+    return deleted
+
+# ------------------ SCHEMA MIGRATIONS ------------------
+# هر مهاجرت یک بار و به ترتیب اجرا می‌شود و نسخه‌ی فعلی در جدول schema_version نگه داشته می‌شود.
+# مهاجرت جدید را فقط به انتهای لیست MIGRATIONS اضافه کنید؛ ترتیب موجود را هرگز تغییر ندهید.
+def _table_columns(cursor, table):
+    return {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+
+def _migration_base_tables(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS expenses (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, amount REAL NOT NULL, category TEXT NOT NULL, note TEXT, timestamp DATETIME NOT NULL)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT, join_date DATETIME NOT NULL, last_seen_shamsi_month INTEGER DEFAULT 0)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS budgets (user_id INTEGER NOT NULL, year INTEGER NOT NULL, month INTEGER NOT NULL, amount REAL NOT NULL, last_alert INTEGER DEFAULT 0, PRIMARY KEY (user_id, year, month))')
+    cursor.execute('CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, last_expense_id INTEGER, edit_state_json TEXT)')
+    # دیتابیس‌های قدیمی این ستون را ندارند
+    if 'last_seen_shamsi_month' not in _table_columns(cursor, 'users'):
+        cursor.execute('ALTER TABLE users ADD COLUMN last_seen_shamsi_month INTEGER DEFAULT 0')
+
+def _migration_expenses_user_time_index(cursor):
+    # ایندکس پوشا: جمع ماهانه و گزارش دسته‌ای بدون مراجعه به جدول اصلی از همین ایندکس خوانده می‌شوند
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_user_time ON expenses (user_id, timestamp, amount, category)')
+    cursor.execute('ANALYZE expenses')
+
+def _migration_monthly_totals(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS monthly_totals (user_id INTEGER NOT NULL, j_year INTEGER NOT NULL, j_month INTEGER NOT NULL, total REAL NOT NULL DEFAULT 0, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, j_year, j_month)) WITHOUT ROWID')
+    rebuild_monthly_totals(cursor)
+
+def _migration_llm_cache(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS llm_cache (cache_key TEXT PRIMARY KEY, category TEXT NOT NULL, note TEXT, created_at REAL NOT NULL) WITHOUT ROWID')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at)')
+
+def _migration_daily_category_totals(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS daily_category_totals (user_id INTEGER NOT NULL, day TEXT NOT NULL, category TEXT NOT NULL, total REAL NOT NULL DEFAULT 0, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, day, category)) WITHOUT ROWID')
+    rebuild_daily_totals(cursor)
+
+def _migration_global_stats(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS global_stats (day TEXT NOT NULL, metric TEXT NOT NULL, value INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (day, metric)) WITHOUT ROWID')
+    cursor.execute('CREATE TABLE IF NOT EXISTS active_users (day TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (day, user_id)) WITHOUT ROWID')
+    # مقدارهای اولیه از داده‌های موجود؛ از این به بعد مسیرهای نوشتن آن‌ها را به‌روز نگه می‌دارند
+    cursor.execute("INSERT OR REPLACE INTO global_stats (day, metric, value) SELECT 'total', 'users', COUNT(*) FROM users")
+    cursor.execute("INSERT OR REPLACE INTO global_stats (day, metric, value) SELECT 'total', 'expenses', COUNT(*) FROM expenses")
+    cursor.execute("INSERT OR REPLACE INTO global_stats (day, metric, value) SELECT DATE(join_date), 'new_users', COUNT(*) FROM users GROUP BY DATE(join_date)")
+    cursor.execute("INSERT OR REPLACE INTO global_stats (day, metric, value) SELECT DATE(timestamp), 'expenses_added', COUNT(*) FROM expenses GROUP BY DATE(timestamp)")
+
+def _migration_expenses_index_columns(cursor):
+    # ایندکس جدول اصلی و آرشیوها را (اگر ستون‌هایش فرق دارد) با EXPENSE_INDEX_COLUMNS از نو می‌سازد
+    for schema in ['main', *attached_archives(cursor.connection)]:
+        columns = [row[2] for row in cursor.execute(f'PRAGMA {schema}.index_info(idx_expenses_user_time)')]
+        if ', '.join(columns) == EXPENSE_INDEX_COLUMNS:
+            continue
+        cursor.execute(f'DROP INDEX IF EXISTS {schema}.idx_expenses_user_time')
+        create_expense_index(cursor, schema)
+        cursor.execute(f'ANALYZE {schema}.expenses')
+
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_expenses_user_time_index,
+    _migration_monthly_totals,
+    _migration_llm_cache,
+    _migration_daily_category_totals,
+    _migration_global_stats,
+    _migration_expenses_index_columns,
+    # نسخه‌ی ۷ قبلاً note را به ایندکس اضافه می‌کرد؛ دیتابیس‌هایی که آن را اجرا کرده‌اند ایندکس باریک را پس می‌گیرند
+    _migration_expenses_index_columns,
+]
+
+def schema_version():
+    get_conn().execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    row = fetchone('SELECT version FROM schema_version')
+    return row[0] if row else 0
+
+def migrate():
+    """مهاجرت‌های اجرا نشده را در یک تراکنش اعمال می‌کند و نسخه‌ی نهایی اسکیما را برمی‌گرداند."""
+    conn = get_conn()
+    current = schema_version()
+    if current >= len(MIGRATIONS):
+        return current
+    with transaction() as cursor:
+        # قفل نوشتن را از ابتدا می‌گیریم تا دو پروسه هم‌زمان مهاجرت را دو بار اجرا نکنند
+        cursor.execute('BEGIN IMMEDIATE')
+        row = cursor.execute('SELECT version FROM schema_version').fetchone()
+        current = row[0] if row else 0
+        for migration in MIGRATIONS[current:]:
+            migration(cursor)
+        cursor.execute('DELETE FROM schema_version')
+        cursor.execute('INSERT INTO schema_version (version) VALUES (?)', (len(MIGRATIONS),))
+    conn.execute('PRAGMA optimize')
+    return len(MIGRATIONS)
+
+# ------------------ ROLLUPS ------------------
+# جمع و تعداد هزینه‌های هر کاربر در هر ماه شمسی (monthly_totals) و در هر روز و دسته (daily_category_totals)
+# هم‌زمان با هر تغییر در expenses و در همان تراکنش به‌روز می‌شوند تا بودجه و گزارش‌ها به جای جمع زدن
+# ردیف‌های خام، از این جدول‌های کوچک خوانده شوند. روزها تاریخ میلادی محلی به شکل YYYY-MM-DD هستند.
+def to_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def shamsi_month_of(timestamp):
+    j_date = jdatetime.date.fromgregorian(date=to_datetime(timestamp).date())
+    return j_date.year, j_date.month
+
+MONTHLY_UPSERT = """
+    INSERT INTO monthly_totals (user_id, j_year, j_month, total, count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, j_year, j_month) DO UPDATE SET
+        total = total + excluded.total,
+        count = count + excluded.count
+"""
+DAILY_UPSERT = """
+    INSERT INTO daily_category_totals (user_id, day, category, total, count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, day, category) DO UPDATE SET
+        total = total + excluded.total,
+        count = count + excluded.count
+"""
+
+def apply_expense_delta(cursor, user_id, timestamp, category, amount_delta, count_delta):
+    """تغییر یک هزینه را (با مقدار و تعداد مثبت یا منفی) به جدول‌های جمع اعمال می‌کند؛ باید در تراکنش همان تغییر صدا زده شود."""
+    j_year, j_month = shamsi_month_of(timestamp)
+    cursor.execute(MONTHLY_UPSERT, (user_id, j_year, j_month, amount_delta, count_delta))
+    cursor.execute(DAILY_UPSERT, (user_id, to_datetime(timestamp).date().isoformat(), category, amount_delta, count_delta))
+
+def apply_expense_deltas(cursor, user_id, expenses):
+    """نسخه‌ی گروهی apply_expense_delta برای هزینه‌های تازه درج‌شده؛ expenses دنباله‌ای از (timestamp, category, amount) است."""
+    monthly, daily = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    for timestamp, category, amount in expenses:
+        for bucket in (monthly[shamsi_month_of(timestamp)], daily[(to_datetime(timestamp).date().isoformat(), category)]):
+            bucket[0] += amount
+            bucket[1] += 1
+    cursor.executemany(MONTHLY_UPSERT, [(user_id, *key, total, count) for key, (total, count) in monthly.items()])
+    cursor.executemany(DAILY_UPSERT, [(user_id, *key, total, count) for key, (total, count) in daily.items()])
+
+def get_monthly_total(user_id, j_year, j_month):
+    row = fetchone("SELECT total FROM monthly_totals WHERE user_id = ? AND j_year = ? AND j_month = ?", (user_id, j_year, j_month))
+    return row[0] if row else 0
+
+def _compute_monthly_totals(cursor, user_id=None):
+    # جمع هر روز در SQL حساب می‌شود و فقط روزهای متمایز (نه تک‌تک ردیف‌ها) در پایتون به ماه شمسی نگاشته می‌شوند
+    user_filter, params = ("", ()) if user_id is None else (" WHERE user_id = ?", (user_id,))
+    rows = cursor.execute(f"SELECT user_id, DATE(timestamp), SUM(amount), COUNT(*) FROM {ALL_EXPENSE_AMOUNTS}{user_filter} GROUP BY user_id, DATE(timestamp)", params)
+    totals, months = {}, {}
+    for row_user_id, day, amount, count in rows:
+        month = months.get(day)
+        if month is None:
+            month = months[day] = shamsi_month_of(day)
+        key = (row_user_id, *month)
+        total, previous = totals.get(key, (0, 0))
+        totals[key] = (total + amount, previous + count)
+    return totals
+
+def rebuild_monthly_totals(cursor, user_id=None):
+    """جدول monthly_totals را (برای یک کاربر یا همه) از روی expenses از نو می‌سازد."""
+    totals = _compute_monthly_totals(cursor, user_id)
+    if user_id is None:
+        cursor.execute("DELETE FROM monthly_totals")
+    else:
+        cursor.execute("DELETE FROM monthly_totals WHERE user_id = ?", (user_id,))
+    cursor.executemany("INSERT INTO monthly_totals (user_id, j_year, j_month, total, count) VALUES (?, ?, ?, ?, ?)",
+                       [(*key, total, count) for key, (total, count) in totals.items()])
+    return len(totals)
+
+def verify_monthly_totals(user_id=None, tolerance=0.01):
+    """ردیف‌هایی از monthly_totals که با expenses هم‌خوانی ندارند را به صورت لیست (کلید، مقدار ذخیره‌شده، مقدار واقعی) برمی‌گرداند."""
+    cursor = get_conn().cursor()
+    expected = _compute_monthly_totals(cursor, user_id)
+    if user_id is None:
+        stored_rows = cursor.execute("SELECT user_id, j_year, j_month, total, count FROM monthly_totals").fetchall()
+    else:
+        stored_rows = cursor.execute("SELECT user_id, j_year, j_month, total, count FROM monthly_totals WHERE user_id = ?", (user_id,)).fetchall()
+    cursor.close()
+    stored = {(u, y, m): (total, count) for u, y, m, total, count in stored_rows}
+    drift = []
+    for key in expected.keys() | stored.keys():
+        stored_total, stored_count = stored.get(key, (0, 0))
+        expected_total, expected_count = expected.get(key, (0, 0))
+        if stored_count != expected_count or abs(stored_total - expected_total) > tolerance:
+            drift.append((key, (stored_total, stored_count), (expected_total, expected_count)))
+    return drift
+
+def rebuild_daily_totals(cursor, user_id=None):
+    """جدول daily_category_totals را (برای یک کاربر یا همه) از روی expenses از نو می‌سازد."""
+    user_filter, params = ("", ()) if user_id is None else (" WHERE user_id = ?", (user_id,))
+    cursor.execute(f"DELETE FROM daily_category_totals{user_filter}", params)
+    cursor.execute(f"""
+        INSERT INTO daily_category_totals (user_id, day, category, total, count)
+        SELECT user_id, DATE(timestamp), category, SUM(amount), COUNT(*) FROM {ALL_EXPENSE_AMOUNTS}{user_filter}
+        GROUP BY user_id, DATE(timestamp), category
+    """, params)
+    return cursor.rowcount
+
+def verify_daily_totals(user_id=None, tolerance=0.01):
+    """تعداد ردیف‌های daily_category_totals که با expenses هم‌خوانی ندارند."""
+    user_filter, params = ("", ()) if user_id is None else (" WHERE user_id = ?", (user_id,))
+    row = fetchone(f"""
+        SELECT COUNT(*) FROM (
+            SELECT user_id, day, category, SUM(total) AS total, SUM(count) AS count FROM (
+                SELECT user_id, day, category, total, count FROM daily_category_totals{user_filter}
+                UNION ALL
+                SELECT user_id, DATE(timestamp), category, -SUM(amount), -COUNT(*) FROM {ALL_EXPENSE_AMOUNTS}{user_filter}
+                GROUP BY user_id, DATE(timestamp), category
+            ) GROUP BY user_id, day, category
+        ) WHERE count != 0 OR ABS(total) > ?
+    """, (*params, *params, tolerance))
+    return row[0]
+
+def category_totals_between(user_id, start_day, end_day):
+    """جمع هر دسته در بازه‌ی روزهای [start_day, end_day) از جدول روزانه، به ترتیب نزولی مبلغ."""
+    return fetchall("""
+        SELECT category, SUM(total) FROM daily_category_totals
+        WHERE user_id = ? AND day >= ? AND day < ?
+        GROUP BY category HAVING SUM(count) > 0 ORDER BY SUM(total) DESC
+    """, (user_id, start_day.isoformat(), end_day.isoformat()))
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# ماژول‌ها تنظیمات را هنگام import از محیط می‌خوانند؛ تست‌ها هرگز به expenses.db واقعی یا تلگرام واقعی دست نمی‌زنند
+_tmp = tempfile.mkdtemp(prefix='jibjib-test-')
+os.environ['DB_PATH'] = os.path.join(_tmp, 'expenses.db')
+os.environ['ARCHIVE_DIR'] = os.path.join(_tmp, 'archive')
+os.environ['BOT_TOKEN'] = '123456:test'
+os.environ['ADMIN_USER_ID'] = '1'
+os.environ['METRICS_PORT'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
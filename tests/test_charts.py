@@ -0,0 +1,46 @@
+from concurrent.futures import Future
+import pytest
+import charts
+
+class _InlinePool:
+    """به جای استخر پروسه، رسم را همین‌جا اجرا می‌کند؛ before_render پیش از هر رسم صدا زده می‌شود."""
+    def __init__(self):
+        self.renders = 0
+        self.before_render = None
+
+    def submit(self, fn, *args):
+        self.renders += 1
+        if self.before_render:
+            self.before_render()
+        future = Future()
+        future.set_result(f'png {self.renders}'.encode())
+        return future
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = _InlinePool()
+    monkeypatch.setattr(charts, '_get_pool', lambda: pool)
+    monkeypatch.setattr(charts, 'DATA_SOURCES', {'pie': lambda user_id, start, end: (['غذا'], [1000], 'test')})
+    monkeypatch.setattr(charts, '_cache', charts.OrderedDict())
+    monkeypatch.setattr(charts, 'CHART_CACHE_SIZE', 4)
+    return pool
+
+def test_cache_hit_until_invalidated(pool):
+    first = charts.render_chart(1)
+    assert charts.render_chart(1) == first and pool.renders == 1
+    charts.invalidate(1)
+    assert charts.render_chart(1) != first and pool.renders == 2
+
+def test_result_of_render_invalidated_midway_is_not_cached(pool):
+    pool.before_render = lambda: charts.invalidate(1)
+    charts.render_chart(1)
+    pool.before_render = None
+    charts.render_chart(1)
+    assert pool.renders == 2
+
+def test_invalidation_state_does_not_grow_with_users(pool):
+    for user_id in range(1000):
+        charts.render_chart(user_id)
+        charts.invalidate(user_id)
+    assert charts._rendering == {}
+    assert len(charts._cache) <= charts.CHART_CACHE_SIZE
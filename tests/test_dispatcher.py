@@ -0,0 +1,31 @@
+import threading
+import pytest
+from dispatcher import UserOrderedExecutor
+
+@pytest.fixture
+def executor():
+    executor = UserOrderedExecutor(max_workers=2, max_pending=64, command_workers=1)
+    yield executor
+    executor.shutdown()
+
+def test_commands_run_while_normal_workers_are_busy(executor):
+    release, done = threading.Event(), threading.Event()
+    for user_id in (1, 2):
+        executor.submit(user_id, release.wait, 5)
+    executor.submit(3, done.set, command=True)
+    assert done.wait(2)
+    release.set()
+
+def test_user_order_is_kept_across_lanes(executor):
+    order, finished = [], threading.Event()
+    gate = threading.Event()
+    def slow(name):
+        gate.wait(5)
+        order.append(name)
+    executor.submit(1, slow, 'message')
+    executor.submit(1, order.append, 'command', command=True)
+    executor.submit(1, order.append, 'message 2')
+    executor.submit(1, finished.set, command=True)
+    gate.set()
+    assert finished.wait(5)
+    assert order == ['message', 'command', 'message 2']
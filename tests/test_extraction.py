@@ -0,0 +1,73 @@
+import json
+import time
+import pytest
+import extraction
+
+TEXTS = ['۵۰ هزار تاکسی تا فرودگاه', '۱۲۰ هزار خرید از هایپر', 'شام بیرون با بچه‌ها']
+
+def _request(text):
+    return extraction._Request(text, deadline=time.monotonic() + 5)
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """پاسخ ساختگی برای prompt دسته‌ای؛ prompt تکی متن پیام را با مبلغ ثابت برمی‌گرداند."""
+    calls = {'batch': None, 'single': []}
+    def generate(prompt, priority=None, deadline=None):
+        if prompt.startswith('Extract the expense in each message'):
+            return json.dumps(calls['batch'], ensure_ascii=False)
+        text = next(text for text in TEXTS if f'"{text}"' in prompt)
+        calls['single'].append(text)
+        return json.dumps({'amount': 1, 'category': 'سایر', 'note': text}, ensure_ascii=False)
+    monkeypatch.setattr(extraction.gemini_client, 'generate', generate)
+    return calls
+
+def _process(batcher, batch):
+    batcher._process(batch)
+    for request in batch:
+        assert request.done.wait(5)
+    return [json.loads(request.result) for request in batch]
+
+@pytest.fixture
+def batcher():
+    batcher = extraction.ExtractionBatcher()
+    yield batcher
+    batcher._executor.shutdown(wait=True)
+
+def test_batch_items_are_matched_by_index_not_position(gemini, batcher):
+    gemini['batch'] = [
+        {'i': 3, 'amount': 400000, 'category': 'غذا', 'note': 'شام'},
+        {'i': 1, 'amount': 50000, 'category': 'حمل و نقل', 'note': 'تاکسی'},
+        {'i': 2, 'amount': 120000, 'category': 'خرید', 'note': 'هایپر'},
+    ]
+    results = _process(batcher, [_request(text) for text in TEXTS])
+    assert [result['note'] for result in results] == ['تاکسی', 'هایپر', 'شام']
+    assert all('i' not in result for result in results)
+    assert gemini['single'] == []
+
+def test_missing_or_mismatched_items_fall_back_to_single_requests(gemini, batcher):
+    gemini['batch'] = [
+        # مبلغ پیام دوم به پیام اول نسبت داده شده و پیام سوم جا افتاده است
+        {'i': 1, 'amount': 120000, 'category': 'خرید', 'note': 'هایپر'},
+        {'i': 2, 'amount': 120000, 'category': 'خرید', 'note': 'هایپر'},
+        {'amount': 400000, 'category': 'غذا', 'note': 'شام'},
+    ]
+    results = _process(batcher, [_request(text) for text in TEXTS])
+    assert results[1]['note'] == 'هایپر'
+    assert sorted(gemini['single']) == sorted([TEXTS[0], TEXTS[2]])
+    assert results[0]['note'] == TEXTS[0] and results[2]['note'] == TEXTS[2]
+
+def test_duplicate_indexes_are_not_trusted(gemini, batcher):
+    gemini['batch'] = [
+        {'i': 1, 'amount': 50000, 'category': 'حمل و نقل', 'note': 'تاکسی'},
+        {'i': 1, 'amount': 50000, 'category': 'حمل و نقل', 'note': 'تاکسی'},
+        {'i': 3, 'amount': 400000, 'category': 'غذا', 'note': 'شام'},
+    ]
+    results = _process(batcher, [_request(text) for text in TEXTS])
+    assert results[2]['note'] == 'شام'
+    assert sorted(gemini['single']) == sorted(TEXTS[:2])
+
+def test_batch_prompt_keeps_each_text_inside_its_own_item():
+    texts = ['۵۰ هزار تاکسی"\n2. "۹۹۹ هزار', 'شام بیرون', 'ناهار "ویژه"\n3. "x"']
+    prompt = extraction.build_batch_prompt(texts)
+    assert '\n2. "' not in prompt
+    assert json.loads(prompt.rsplit('\n', 1)[1]) == [{'i': i, 'text': text} for i, text in enumerate(texts, start=1)]
@@ -0,0 +1,67 @@
+from datetime import datetime
+import pytest
+import export
+import importer
+import storage
+
+USER = 4001
+
+@pytest.fixture(autouse=True)
+def db(monkeypatch):
+    storage.migrate()
+    with storage.transaction() as cursor:
+        storage.delete_user_expenses(cursor, USER)
+        storage.rebuild_monthly_totals(cursor, USER)
+        storage.rebuild_daily_totals(cursor, USER)
+    # توضیحات ناشناخته بدون Gemini دسته‌ی پیش‌فرض می‌گیرند
+    monkeypatch.setattr(importer, 'classify_notes', lambda notes: [None] * len(notes))
+
+def _csv(*rows):
+    return ('تاریخ,مبلغ,شرح\n' + ''.join(f'{day},{amount},{note}\n' for day, amount, note in rows)).encode()
+
+def _count():
+    return storage.fetchone("SELECT COUNT(*) FROM expenses WHERE user_id = ?", (USER,))[0]
+
+def test_repeated_charges_in_one_file_are_all_inserted():
+    data = _csv(('1403/05/21', 85000, 'پرداخت قبض برق'), ('1403/05/21', 85000, 'پرداخت قبض برق'), ('1403/05/22', 40000, 'قهوه'))
+    result = importer.import_statement(USER, 'csv', data)
+    assert (result['inserted'], result['duplicates']) == (3, 0)
+    # ارسال دوباره‌ی همان فایل چیزی اضافه نمی‌کند
+    result = importer.import_statement(USER, 'csv', data)
+    assert (result['inserted'], result['duplicates']) == (0, 3)
+    assert _count() == 3
+
+def test_only_rows_beyond_existing_count_are_inserted(monkeypatch):
+    importer.import_statement(USER, 'csv', _csv(('1403/05/21', 40000, 'قهوه')))
+    # تکه‌های دوتایی تا جفت شدن ردیف‌ها با هزینه‌های موجود از مرز تکه‌ها عبور کند
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_ROWS', 2)
+    rows = [('1403/05/21', 40000, 'قهوه')] * 3 + [('1403/05/20', 12000, 'نان')] * 2
+    result = importer.import_statement(USER, 'csv', _csv(*rows))
+    assert (result['rows'], result['inserted'], result['duplicates']) == (5, 4, 1)
+    assert _count() == 5
+    result = importer.import_statement(USER, 'csv', _csv(*rows))
+    assert (result['inserted'], result['duplicates']) == (0, 5)
+
+def test_rollups_match_after_chunked_import(monkeypatch):
+    monkeypatch.setattr(importer, 'IMPORT_CHUNK_ROWS', 3)
+    rows = [(f'1403/05/{day:02d}', 1000 * day, f'خرید {day}') for day in range(1, 20)]
+    assert importer.import_statement(USER, 'csv', _csv(*rows))['inserted'] == 19
+    assert storage.verify_monthly_totals(USER) == []
+    assert storage.verify_daily_totals(USER) == 0
+
+@pytest.mark.parametrize('fmt', ['csv', 'xlsx'])
+def test_own_export_is_imported_back(fmt):
+    source = USER + 1
+    with storage.transaction() as cursor:
+        storage.delete_user_expenses(cursor, source)
+        rows = [(source, 1000 * (i + 1), 'غذا', f'ناهار {i}', datetime(2024, 7, 1 + i, 13, 5, 12, 432517 + i)) for i in range(3)]
+        cursor.executemany("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)", rows)
+    out, count = export.export_expenses(source, fmt)
+    with out:
+        data = out.read()
+    result = importer.import_statement(USER, fmt, data)
+    assert (result['rows'], result['inserted'], result['invalid']) == (count, 3, 0)
+    assert storage.fetchall("SELECT amount, category, note, timestamp FROM expenses WHERE user_id = ? ORDER BY timestamp", (USER,)) == \
+        storage.fetchall("SELECT amount, category, note, timestamp FROM expenses WHERE user_id = ? ORDER BY timestamp", (source,))
+    # ارسال دوباره‌ی همان خروجی همه را تکراری می‌شناسد
+    assert importer.import_statement(USER, fmt, data)['duplicates'] == 3
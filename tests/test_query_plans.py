@@ -0,0 +1,98 @@
+import re
+from datetime import datetime
+import pytest
+import archive
+import export
+import importer
+import stats
+import storage
+
+INDEX_PLAN = 'USING COVERING INDEX idx_expenses_user_time'
+# اسکن کامل جدول expenses (SCAN all_expenses فقط خواندن خروجی co-routine نماست)
+TABLE_SCAN = re.compile(r'^SCAN (\w+\.)?expenses\b')
+START, END = datetime(2024, 3, 20), datetime(2024, 4, 20)
+
+@pytest.fixture(scope='module', autouse=True)
+def db():
+    storage.migrate()
+    with storage.transaction() as cursor:
+        cursor.executemany("INSERT INTO expenses (user_id, amount, category, note, timestamp) VALUES (?, ?, ?, ?, ?)",
+                           [(user_id, 1000 * day, 'غذا', 'ناهار', datetime(year, 3, day + 1))
+                            for user_id in (1, 2) for year in (2023, 2024) for day in range(28)])
+    # سال ۱۴۰۱ بایگانی می‌شود تا all_expenses اجتماع جدول اصلی و یک آرشیو باشد
+    assert archive.archive_year(1401) > 0
+    yield
+    storage.close_all()
+
+def _plan(sql, params=()):
+    return [row[3] for row in storage.get_conn().execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+def _traced(call):
+    """متن SQL اجراشده توسط کد واقعی را (با پارامترهای جاگذاری‌شده) برمی‌گرداند."""
+    statements = []
+    conn = storage.get_conn()
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    return [sql for sql in statements if sql.lstrip().upper().startswith('SELECT')]
+
+def _assert_covered(sql, params=()):
+    plan = _plan(sql, params)
+    assert any(INDEX_PLAN in step for step in plan), plan
+    if storage.ALL_EXPENSE_AMOUNTS in sql:
+        # هر دو شاخه‌ی UNION ALL (جدول اصلی و آرشیو) باید از ایندکس بخوانند
+        assert sum(INDEX_PLAN in step for step in plan) >= 2, plan
+    assert not any(TABLE_SCAN.match(step) for step in plan), plan
+
+def _assert_primary_key_search(statements, table):
+    statements = [sql for sql in statements if table in sql]
+    assert statements
+    for sql in statements:
+        plan = _plan(sql)
+        assert any(step.startswith(f'SEARCH {table} USING PRIMARY KEY (') for step in plan), plan
+        assert not any(step.startswith('SCAN') for step in plan), plan
+
+def test_monthly_total_reads_rollup_by_primary_key():
+    # بودجه، هشدار بودجه و خلاصه‌ی ماه همه از get_monthly_total می‌خوانند
+    _assert_primary_key_search(_traced(lambda: storage.get_monthly_total(1, 1403, 1)), 'monthly_totals')
+
+def test_report_reads_daily_rollup_by_primary_key():
+    # /report و /reportdaily و /reportweekly
+    _assert_primary_key_search(_traced(lambda: storage.category_totals_between(1, START.date(), END.date())), 'daily_category_totals')
+
+def test_stats_read_global_stats_by_primary_key():
+    _assert_primary_key_search(_traced(lambda: stats.read_stats()), 'global_stats')
+
+def test_monthly_rebuild_uses_covering_index():
+    statements = _traced(lambda: storage._compute_monthly_totals(storage.get_conn().cursor(), 1))
+    assert statements
+    for sql in statements:
+        _assert_covered(sql)
+
+def _assert_index_search(sql):
+    """خواننده‌هایی که note لازم دارند: هر منبع با ایندکس جستجو می‌شود و ردیف‌ها از جدول خوانده می‌شوند."""
+    plan = _plan(sql)
+    assert sum('USING INDEX idx_expenses_user_time' in step for step in plan) >= 2, plan
+    assert not any(TABLE_SCAN.match(step) for step in plan), plan
+    return plan
+
+def test_export_query_uses_index():
+    statements = _traced(lambda: list(export.iter_expense_pages(1, START, END)))
+    assert len(statements) == 1
+    # ترتیب زمانی هم از ایندکس می‌آید و مرتب‌سازی جداگانه‌ای لازم نیست
+    assert not any('TEMP B-TREE' in step for step in _assert_index_search(statements[0]))
+
+def test_export_summary_uses_covering_index():
+    statements = _traced(lambda: export.category_totals(1))
+    _assert_covered(statements[0])
+    statements = _traced(lambda: export.category_totals(1, START, END))
+    _assert_covered(statements[0])
+
+def test_import_duplicate_lookup_uses_index():
+    statements = _traced(lambda: importer._existing_counts(1, START, END))
+    _assert_index_search(statements[0])
+
+def test_expense_index_has_no_note():
+    assert [row[2] for row in storage.fetchall('PRAGMA index_info(idx_expenses_user_time)')] == ['user_id', 'timestamp', 'amount', 'category']
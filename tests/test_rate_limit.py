@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+import pytest
+import rate_limit
+from rate_limit import BULK, INTERACTIVE, GeminiLimiter, RateLimited
+
+def test_user_bucket_refuses_beyond_burst():
+    limiter = GeminiLimiter(rate=100, burst=100, user_rate=1 / 60, user_burst=2)
+    limiter.admit(1)
+    limiter.admit(1)
+    with pytest.raises(RateLimited) as refused:
+        limiter.admit(1)
+    assert refused.value.reason == 'user'
+    limiter.admit(2)
+
+def test_waits_for_a_token_within_the_deadline():
+    limiter = GeminiLimiter(rate=10, burst=1)
+    limiter.acquire()
+    started = time.monotonic()
+    limiter.acquire(INTERACTIVE, time.monotonic() + 1)
+    assert 0.05 < time.monotonic() - started < 0.5
+
+def test_refuses_when_the_deadline_cannot_be_met():
+    limiter = GeminiLimiter(rate=1, burst=1)
+    limiter.acquire()
+    started = time.monotonic()
+    with pytest.raises(RateLimited) as refused:
+        limiter.acquire(INTERACTIVE, time.monotonic() + 0.2)
+    assert refused.value.reason == 'deadline'
+    # بدون انتظار بیهوده تا خود مهلت
+    assert time.monotonic() - started < 0.1
+
+def test_refuses_when_the_wait_queue_is_full():
+    limiter = GeminiLimiter(rate=2, burst=1, max_waiting=2)
+    limiter.acquire()
+    waiters = [threading.Thread(target=limiter.acquire, args=(INTERACTIVE, time.monotonic() + 5)) for _ in range(2)]
+    for waiter in waiters: waiter.start()
+    deadline = time.monotonic() + 1
+    while limiter.waiting() < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(RateLimited) as refused:
+        limiter.acquire(INTERACTIVE, time.monotonic() + 5)
+    assert refused.value.reason == 'queue_full'
+    for waiter in waiters: waiter.join(5)
+
+def test_interactive_requests_go_before_bulk():
+    limiter = GeminiLimiter(rate=5, burst=1)
+    limiter.acquire()
+    order = []
+    def wait(priority, name):
+        limiter.acquire(priority, time.monotonic() + 5)
+        order.append(name)
+    bulk = threading.Thread(target=wait, args=(BULK, 'bulk'))
+    bulk.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=wait, args=(INTERACTIVE, 'interactive'))
+    interactive.start()
+    bulk.join(5); interactive.join(5)
+    assert order == ['interactive', 'bulk']
+
+def test_penalize_pauses_all_requests():
+    limiter = GeminiLimiter(rate=100, burst=100)
+    limiter.penalize(0.3)
+    started = time.monotonic()
+    limiter.acquire(INTERACTIVE, time.monotonic() + 2)
+    assert time.monotonic() - started >= 0.25
+
+def test_client_retries_take_a_token_each(monkeypatch):
+    import gemini_client
+    statuses = iter([503, 503, 200])
+    class Response:
+        headers = {}
+        text = ''
+        def __init__(self):
+            self.status_code = next(statuses)
+        def json(self):
+            return {'candidates': [{'content': {'parts': [{'text': 'ok'}]}}]}
+    acquired = []
+    monkeypatch.setattr(rate_limit.limiter, 'acquire', lambda priority=INTERACTIVE, deadline=None: acquired.append(priority))
+    monkeypatch.setattr(gemini_client, '_backoff', lambda attempt: 0)
+    client = gemini_client.GeminiClient(retries=2)
+    monkeypatch.setattr(client._session, 'post', lambda *args, **kwargs: Response())
+    assert client.generate('x', BULK) == 'ok'
+    # تلاش اول توکنش را در gemini_client.generate می‌گیرد؛ دو تلاش مجدد هر کدام یکی
+    assert acquired == [BULK, BULK]
+
+def test_async_waiters_share_the_queue_with_threads():
+    limiter = GeminiLimiter(rate=10, burst=1)
+    limiter.acquire()
+    order = []
+    def wait_in_thread():
+        limiter.acquire(BULK, time.monotonic() + 5)
+        order.append('thread')
+    async def scenario():
+        thread = threading.Thread(target=wait_in_thread)
+        thread.start()
+        await asyncio.sleep(0.02)
+        await limiter.acquire_async(INTERACTIVE, time.monotonic() + 5)
+        order.append('async')
+        with pytest.raises(RateLimited):
+            await limiter.acquire_async(INTERACTIVE, time.monotonic() + 0.01)
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+    asyncio.run(scenario())
+    assert order == ['async', 'thread']
+    assert limiter.waiting() == 0
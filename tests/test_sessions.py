@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime
+import pytest
+import sessions
+import storage
+
+USERS = (3001, 3002, 3003)
+
+@pytest.fixture
+def small_cache(monkeypatch):
+    storage.migrate()
+    with storage.transaction() as cursor:
+        cursor.executemany("INSERT OR REPLACE INTO users (user_id, first_name, username, join_date, last_seen_shamsi_month) VALUES (?, ?, ?, ?, 0)",
+                           [(user_id, 'test', None, datetime.now()) for user_id in USERS])
+    sessions.flush()
+    monkeypatch.setattr(sessions, 'SESSION_CACHE_SIZE', 1)
+    monkeypatch.setattr(sessions, '_sessions', sessions.OrderedDict())
+    monkeypatch.setattr(sessions, '_evicted', {})
+    yield
+    sessions.flush()
+
+@pytest.fixture
+def blocked_write(monkeypatch):
+    """_write تا set شدن release منتظر می‌ماند؛ started وقتی set می‌شود که نوشتنی شروع شده باشد."""
+    started, release = threading.Event(), threading.Event()
+    write = sessions._write
+    def blocked(states, months):
+        started.set()
+        assert release.wait(5)
+        write(states, months)
+    monkeypatch.setattr(sessions, '_write', blocked)
+    yield started, release
+    release.set()
+
+def _month_in_db(user_id):
+    return storage.fetchone("SELECT last_seen_shamsi_month FROM users WHERE user_id = ?", (user_id,))[0]
+
+def test_evicted_session_is_not_reloaded_stale_while_its_write_is_pending(small_cache, blocked_write):
+    started, release = blocked_write
+    sessions.mark_month_seen(USERS[0], 7)
+    # کاربر دوم کاربر اول را بیرون می‌راند و نوشتن آن پشت release می‌ماند
+    evictor = threading.Thread(target=sessions.get_session, args=(USERS[1],))
+    evictor.start()
+    assert started.wait(5)
+    assert _month_in_db(USERS[0]) == 0
+    assert sessions.get_session(USERS[0]).last_seen_shamsi_month == 7
+
+    # جلسه‌ی برگشته (بدون تغییر جدید) دوباره بیرون رانده می‌شود در حالی که نوشتن هنوز commit نشده است
+    second = threading.Thread(target=sessions.get_session, args=(USERS[2],))
+    second.start()
+    second.join(0.2)
+    assert sessions.get_session(USERS[0]).last_seen_shamsi_month == 7
+
+    release.set()
+    evictor.join(5)
+    second.join(5)
+    sessions.flush()
+    assert _month_in_db(USERS[0]) == 7
+    assert not sessions._evicted and not sessions._writing
+
+def test_updates_always_land_on_the_cached_session(small_cache):
+    def worker(user_id):
+        for month in range(1, 200):
+            sessions.mark_month_seen(user_id, month)
+            sessions.update_state(user_id, last_expense_id=month)
+    threads = [threading.Thread(target=worker, args=(user_id,)) for user_id in USERS]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    sessions.flush()
+    for user_id in USERS:
+        assert _month_in_db(user_id) == 199
+        assert storage.fetchone("SELECT last_expense_id FROM user_state WHERE user_id = ?", (user_id,))[0] == 199
+        assert sessions.get_session(user_id).last_seen_shamsi_month == 199
+
+def test_failed_write_keeps_changes_dirty(small_cache, monkeypatch):
+    sessions.mark_month_seen(USERS[0], 9)
+    write = sessions._write
+    def failing(states, months):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(sessions, '_write', failing)
+    with pytest.raises(RuntimeError):
+        sessions.flush()
+    monkeypatch.setattr(sessions, '_write', write)
+    sessions.flush()
+    assert _month_in_db(USERS[0]) == 9
@@ -0,0 +1,14 @@
+import os
+from types import SimpleNamespace
+import bench
+
+# بودجه‌ی شروع سرد؛ import تنها matplotlib یا pandas از آن بیشتر است. روی ماشین کند CI با متغیر محیطی بالاتر ببرید
+MAX_IMPORT_MS = float(os.environ.get('STARTUP_MAX_IMPORT_MS', '1000'))
+MAX_FIRST_UPDATE_MS = float(os.environ.get('STARTUP_MAX_FIRST_UPDATE_MS', '1500'))
+
+def test_cold_start_stays_light_and_fast():
+    # میانه‌ی سه اجرا در پروسه‌های تازه (همان سناریوی startup در bench.py)
+    result = bench.bench_startup(SimpleNamespace(startup_runs=3))
+    assert result['heavy_modules_loaded'] == []
+    assert result['import_ms'] < MAX_IMPORT_MS, result
+    assert result['first_update_ms'] < MAX_FIRST_UPDATE_MS, result
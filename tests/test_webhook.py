@@ -0,0 +1,118 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+import bench
+import gemini_client
+import main
+import rate_limit
+import storage
+import webhook
+from dispatcher import UserOrderedExecutor
+
+USERS = (2001, 2002, 2003)
+
+@pytest.fixture
+def stub_gemini():
+    server = bench.StubGeminiServer(latency=0.05)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def replies(monkeypatch):
+    """پیام‌هایی که هندلرها به تلگرام می‌فرستند به شکل (chat_id، متن)."""
+    sent = []
+    monkeypatch.setattr(main.bot, 'send_message', lambda chat_id, text, **kwargs: sent.append((chat_id, text)))
+    monkeypatch.setattr(main.bot, 'reply_to', lambda message, text, **kwargs: sent.append((message.chat.id, text)))
+    monkeypatch.setattr(main.bot, 'send_chat_action', lambda *args, **kwargs: None)
+    # on_cleanup اجراکننده را می‌بندد؛ تست روی یک اجراکننده‌ی جدا اجرا می‌شود
+    monkeypatch.setattr(main.bot, 'executor', UserOrderedExecutor())
+    main.init_db()
+    return sent
+
+def _update(update_id, user_id, text):
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private'}, 'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+async def _wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'handlers did not reply in time'
+        await asyncio.sleep(0.02)
+
+def _saved(sent, user_id):
+    return [text for chat_id, text in sent if chat_id == user_id and text.startswith('✅ هزینه ثبت شد')]
+
+def test_webhook_handles_updates_with_stub_gemini(stub_gemini, replies):
+    async def scenario():
+        async with TestClient(TestServer(webhook.create_app(gemini_url=stub_gemini.url))) as client:
+            assert gemini_client._async_client is not None
+            update_id = 1
+            for user_id in USERS:
+                response = await client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(update_id, user_id, '/start')))
+                assert response.status == 200
+                update_id += 1
+            for user_id in USERS:
+                # متنی که تحلیلگر محلی نمی‌فهمد و به Gemini ساختگی می‌رسد
+                response = await client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(update_id, user_id, f'{user_id % 100} تومن بابت سفارش شماره {update_id} از فروشگاه')))
+                assert response.status == 200
+                update_id += 1
+            await _wait_for(lambda: all(_saved(replies, user_id) for user_id in USERS))
+        assert gemini_client._async_client is None
+
+    asyncio.run(scenario())
+    assert stub_gemini.requests >= 1
+    for user_id in USERS:
+        assert any('👋' in text or 'سلام' in text for chat_id, text in replies if chat_id == user_id)
+        assert storage.fetchone("SELECT amount FROM expenses WHERE user_id = ?", (user_id,))[0] == (user_id % 100) * 1000
+
+def test_webhook_rejects_wrong_secret(stub_gemini, replies, monkeypatch):
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET', 'secret')
+    async def scenario():
+        async with TestClient(TestServer(webhook.create_app(gemini_url=stub_gemini.url))) as client:
+            response = await client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(1, USERS[0], '/help')),
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+            assert response.status == 403
+            response = await client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(2, USERS[0], '/help')),
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            assert response.status == 200
+            await _wait_for(lambda: replies)
+
+    asyncio.run(scenario())
+    assert [chat_id for chat_id, text in replies] == [USERS[0]]
+
+def test_burst_of_gemini_messages_waits_for_tokens_instead_of_refusing(stub_gemini, replies, monkeypatch):
+    # بیشتر از کارگرهای dispatcher پیام هم‌زمان، با سطل سراسری کوچک؛ پیام‌ها تا مهلتشان منتظر توکن می‌مانند
+    monkeypatch.setattr(rate_limit, 'limiter', rate_limit.GeminiLimiter(rate=2, burst=2))
+    users = range(2101, 2121)
+    async def scenario():
+        async with TestClient(TestServer(webhook.create_app(gemini_url=stub_gemini.url))) as client:
+            await asyncio.gather(*(client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(user_id, user_id, f'{user_id % 100} تومن بابت سفارش شماره {user_id} از فروشگاه')))
+                                   for user_id in users))
+            await _wait_for(lambda: all(_saved(replies, user_id) for user_id in users))
+
+    asyncio.run(scenario())
+    assert not [text for chat_id, text in replies if 'شلوغ' in text]
+    # پیام‌ها دسته‌ای فرستاده شده‌اند، نه یک درخواست به ازای هر پیام
+    assert stub_gemini.requests < len(users)
+
+def test_gemini_wait_does_not_hold_a_worker_thread(stub_gemini, replies, monkeypatch):
+    # با یک کارگر عادی، اگر هر پیام تا پاسخ Gemini تردی نگه می‌داشت پیام‌ها یکی‌یکی و هر کدام با درخواست جدا می‌رفتند
+    monkeypatch.setattr(main.bot, 'executor', UserOrderedExecutor(max_workers=1, command_workers=1))
+    stub_gemini.latency = 0.3
+    users = range(2201, 2206)
+    async def scenario():
+        async with TestClient(TestServer(webhook.create_app(gemini_url=stub_gemini.url))) as client:
+            for user_id in users:
+                await client.post(webhook.WEBHOOK_PATH, data=json.dumps(_update(user_id, user_id, f'{user_id % 100} تومن بابت سفارش شماره {user_id} از فروشگاه')))
+            await _wait_for(lambda: all(_saved(replies, user_id) for user_id in users))
+
+    asyncio.run(scenario())
+    assert stub_gemini.requests == 1
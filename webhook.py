@@ -0,0 +1,128 @@
+import asyncio
+import concurrent.futures
+import os
+from aiohttp import web
+from telebot import types
+import main
+import extraction
+import storage
+import sessions
+import stats
+import charts
+import gemini_client
+import metrics
+from dispatcher import MAX_PENDING_UPDATES, is_command_update, update_user_id
+from rate_limit import RateLimited
+
+# ------------------ WEBHOOK ENTRY POINT ------------------
+# اجرای ربات در حالت webhook روی یک سرور aiohttp به جای long polling:
+#   python webhook.py
+# آپدیت‌های هر کاربر روی event loop پشت سر هم (هر کدام بعد از تمام شدن قبلی) پردازش می‌شوند. پیام متنی که به
+# Gemini نیاز دارد روی خود loop منتظر پاسخ می‌ماند (extract_expense_async و AsyncGeminiClient با استخر اتصال
+# keep-alive)؛ فقط بخش‌های کوتاه همگام پیش و پس از آن (دیتابیس و ارسال به تلگرام با TeleBot همگام) در صف همان
+# کاربر روی تردهای dispatcher اجرا می‌شوند، پس هیچ تردی منتظر Gemini نمی‌ماند. بقیه‌ی آپدیت‌ها (دستورها،
+# دکمه‌ها، فایل‌ها و پاسخ‌های next step) همان هندلرهای همگام را روی تردهای dispatcher اجرا می‌کنند.
+# برای تست محلی، WEBHOOK_URL را خالی بگذارید (set_webhook صدا زده نمی‌شود)، GEMINI_URL و TELEGRAM_API_URL را
+# به سرورهای ساختگی بدهید و آپدیت‌های JSON را به http://WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH بفرستید؛
+# tests/test_webhook.py همین کار را با bench.StubGeminiServer و aiohttp TestClient انجام می‌دهد.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+def _run_sync(user_id, fn, *args, command=False):
+    """fn همگام را در صف کاربر روی dispatcher اجرا می‌کند و future نتیجه‌ی آن را برمی‌گرداند."""
+    future = concurrent.futures.Future()
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    # هر کاربر حداکثر یک کار در dispatcher دارد و تعداد آپدیت‌های در حال پردازش به MAX_PENDING_UPDATES محدود است،
+    # پس submit منتظر جای خالی نمی‌ماند
+    main.bot.executor.submit(user_id, run, command=command)
+    return asyncio.wrap_future(future)
+
+def _is_free_text(message):
+    return (message is not None and message.content_type == 'text' and not message.text.startswith('/')
+            and not main.bot.has_next_step_handler(message.chat.id))
+
+async def _handle_text_message(user_id, message):
+    needs_ai, parsed = await _run_sync(user_id, main.prepare_text_expense, message)
+    if not needs_ai:
+        return
+    try:
+        ai_response = await extraction.extract_expense_async(message.text, message.from_user.id)
+    except RateLimited:
+        await _run_sync(user_id, main.finish_text_expense, message, parsed, None, True); return
+    await _run_sync(user_id, main.finish_text_expense, message, parsed, ai_response)
+
+async def _process_update(update, user_id, previous):
+    if previous is not None:
+        await asyncio.wait([previous])
+    try:
+        # next step handler فقط بعد از تمام شدن آپدیت قبلی همین کاربر معلوم است
+        if _is_free_text(update.message):
+            with metrics.timer(metrics.HANDLER_SECONDS, handler='handle_text_message'):
+                await _handle_text_message(user_id, update.message)
+        else:
+            await _run_sync(user_id, main.bot.process_updates_inline, [update], command=is_command_update(update, main.bot.slow_commands))
+    except Exception as e:
+        print(f"❌ Webhook update Error (user {user_id}): {e}")
+
+async def handle_update(request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    update = types.Update.de_json(await request.text())
+    # وقتی MAX_PENDING_UPDATES آپدیت در حال پردازش باشند پاسخ webhook دیر می‌شود (فشار برگشتی روی تلگرام)
+    await request.app['slots'].acquire()
+    user_id = update_user_id(update)
+    if update.message is not None:
+        stats.record_message(user_id)
+    tails = request.app['user_tails']
+    task = asyncio.create_task(_process_update(update, user_id, tails.get(user_id)))
+    tails[user_id] = task
+    def done(task):
+        request.app['slots'].release()
+        if tails.get(user_id) is task:
+            del tails[user_id]
+    task.add_done_callback(done)
+    return web.Response()
+
+async def on_startup(app):
+    app['slots'] = asyncio.Semaphore(MAX_PENDING_UPDATES)
+    client = gemini_client.AsyncGeminiClient(url=app['gemini_url'])
+    await client.start()
+    gemini_client.use_async_client(client, asyncio.get_running_loop())
+    app['gemini'] = client
+    if WEBHOOK_URL:
+        main.bot.remove_webhook()
+        main.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+async def on_cleanup(app):
+    # اول کارهای در حال اجرا تمام شوند، بعد کلاینت Gemini که به آن نیاز دارند بسته شود
+    await asyncio.gather(*app['user_tails'].values())
+    await asyncio.get_running_loop().run_in_executor(None, main.bot.executor.shutdown)
+    gemini_client.clear_async_client()
+    await app['gemini'].close()
+    sessions.shutdown()
+    stats.shutdown()
+    storage.close_all()
+
+def create_app(gemini_url=gemini_client.GEMINI_URL):
+    app = web.Application()
+    app['gemini_url'] = gemini_url
+    # آخرین task هر کاربر؛ آپدیت بعدی او تا تمام شدنش صبر می‌کند
+    app['user_tails'] = {}
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == '__main__':
+    print("🚀 Bot starting (webhook mode)...")
+    main.init_db()
+    charts.start()
+    metrics.start_server()
+    web.run_app(create_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)